@@ -30,6 +30,27 @@ Recommend use Nerd font to render icon in terminal."
   :type 'integer
   :group 'eaf-pyqterminal)
 
+(defcustom eaf-pyqterminal-flood-threshold 65536
+  "Output rate in bytes per second to enter flood mode.
+
+In flood mode, the terminal is refreshed every
+`eaf-pyqterminal-flood-refresh-ms' and only shows the latest screen."
+  :type 'integer
+  :group 'eaf-pyqterminal)
+
+(defcustom eaf-pyqterminal-flood-refresh-ms 250
+  "Refresh interval of the terminal in flood mode."
+  :type 'integer
+  :group 'eaf-pyqterminal)
+
+(defcustom eaf-pyqterminal-notify-interval-ms 50
+  "Minimum interval of notifying Emacs of the title, directory and mode.
+
+Only the latest value is sent, so programs changing the title on every
+frame don't flood Emacs."
+  :type 'integer
+  :group 'eaf-pyqterminal)
+
 (defcustom eaf-pyqterminal-cursor-type "box"
   "Type of cursor.
 
@@ -42,6 +63,61 @@ You can set this variable to `box', `bar' and `hbar'."
   :type 'integer
   :group 'eaf-pyqterminal)
 
+(defcustom eaf-pyqterminal-cursor-blink-ms 0
+  "Blink interval of cursor, if 0, the cursor doesn't blink."
+  :type 'integer
+  :group 'eaf-pyqterminal)
+
+(defcustom eaf-pyqterminal-use-host nil
+  "If non-nil, terminals run in a host process which outlives EAF.
+
+Killing the buffer detaches the terminal, and the next terminal of the
+same command and directory attaches to it.  The host parses the output
+too, to rebuild the screen of attaching terminals, so the output costs
+about twice the CPU.  Not supported on Windows."
+  :type 'boolean
+  :group 'eaf-pyqterminal)
+
+(defcustom eaf-pyqterminal-pool-size 0
+  "Number of shells spawned ahead of time for each shell command.
+
+A new terminal takes a spawned shell, which changes to the directory of
+the terminal, so it doesn't wait for the startup of the shell."
+  :type 'integer
+  :group 'eaf-pyqterminal)
+
+(defcustom eaf-pyqterminal-scrollback-budget (* 256 1024 1024)
+  "Estimated memory in bytes of the scrollback of all terminals.
+
+Beyond it, the oldest lines of the terminals viewed least recently are
+compressed, then dropped.  If 0, the scrollback isn't limited."
+  :type 'integer
+  :group 'eaf-pyqterminal)
+
+(defcustom eaf-pyqterminal-triggers nil
+  "Triggers on the output of terminals, a list of (NAME REGEXP).
+
+REGEXP is a Python regexp matched against every complete line of output
+and the line of the cursor.  Matching lines are marked, and
+`eaf-pyqterminal-trigger-functions' are called at most once a second
+for each trigger."
+  :type '(repeat (list string string))
+  :group 'eaf-pyqterminal)
+
+(defcustom eaf-pyqterminal-trigger-functions '(eaf-pyqterminal-trigger-message)
+  "Functions called with the buffer, the name and the line of a trigger."
+  :type 'hook
+  :group 'eaf-pyqterminal)
+
+(defcustom eaf-pyqterminal-minimap-width 0
+  "Width in pixels of the minimap of the scrollback beside terminals.
+
+The minimap shows the length and color of the lines, prompts and
+triggers.  Clicking or dragging on it scrolls to the lines under the
+pointer.  If 0, there is no minimap."
+  :type 'integer
+  :group 'eaf-pyqterminal)
+
 (defcustom eaf-pyqterminal-cursor-alpha -1
   "Alpha of cursor.
 
@@ -56,6 +132,14 @@ If you feel the display is blurry, try setting it to 2."
   :type 'integer
   :group 'eaf-pyqterminal)
 
+(defcustom eaf-pyqterminal-session-directory nil
+  "Directory to save the scrollback of terminals.
+
+The scrollback is restored when the same command is opened in the same
+directory again.  If nil, don't save the scrollback."
+  :type '(choice (const nil) directory)
+  :group 'eaf-pyqterminal)
+
 (defcustom eaf-pyqterminal-color-schema-from-emacs nil
   "Whether color schema from emacs."
   :type 'booleanp
@@ -91,6 +175,10 @@ If you feel the display is blurry, try setting it to 2."
     ("C-c C-c" . "eaf-send-second-key-sequence")
     ("C-c C-x" . "eaf-send-second-key-sequence")
     ("C-c C-m" . "eaf-send-second-key-sequence")
+    ("C-c C-p" . "previous_prompt")
+    ("C-c C-n" . "next_prompt")
+    ("C-c C-o" . "copy_last_output")
+    ("C-c C-d" . "detach_terminal")
     ("C-d" . "eaf-send-key-sequence")
     ("C-e" . "eaf-send-key-sequence")
     ("C-f" . "eaf-send-key-sequence")
@@ -147,6 +235,9 @@ If you feel the display is blurry, try setting it to 2."
     ("i" . "copy_word")
     ("I" . "copy_symbol")
     ("f" . "open_link")
+    ("[" . "previous_prompt")
+    ("]" . "next_prompt")
+    ("o" . "select_last_output")
     ("q" . "toggle_cursor_move_mode")
     ("C-a" . "move_beginning_of_line")
     ("C-e" . "move_end_of_line")
@@ -219,6 +310,31 @@ If ALWAYS-NEW is non-nil, always open a new terminal for the dedicated DIR."
     (eaf--gen-keybinding-map eaf-pyqterminal-keybinding))
   (setq eaf--buffer-map-alist (list (cons t eaf-mode-map))))
 
+(defun eaf--pyqterminal-export-begin (buffer)
+  "Clear BUFFER and show it for an export."
+  (with-current-buffer (get-buffer-create buffer)
+    (let ((inhibit-read-only t))
+      (erase-buffer)))
+  (display-buffer buffer))
+
+(defun eaf--pyqterminal-export-insert (buffer text)
+  "Insert a chunk TEXT of an export at the end of BUFFER."
+  (with-current-buffer (get-buffer-create buffer)
+    (save-excursion
+      (let ((inhibit-read-only t))
+        (goto-char (point-max))
+        (insert text)))))
+
+(defun eaf-pyqterminal-trigger-message (buffer name text)
+  "Show the trigger NAME of BUFFER and its line TEXT."
+  (message "[%s] %s: %s" (buffer-name buffer) name text))
+
+(defun eaf--pyqterminal-trigger (buffer-id name text)
+  "Run `eaf-pyqterminal-trigger-functions' for the trigger NAME."
+  (let ((buffer (eaf-get-buffer buffer-id)))
+    (when buffer
+      (run-hook-with-args 'eaf-pyqterminal-trigger-functions buffer name text))))
+
 (defun eaf-pyqterminal-get-color-schema ()
   (if eaf-pyqterminal-color-schema-from-emacs
       `(("blue" ,(face-foreground 'term-color-blue))
@@ -1,9 +1,16 @@
 # Copyright (C) 2023 by Mumulhl <mumulhl@duck.com>
 # SPDX-License-Identifier: GPL-3.0-or-later
 
+import atexit
+import json
 import os
 import platform
+import shlex
+import socket
+import struct
 import threading
+import time
+from collections import deque
 
 import psutil
 
@@ -12,15 +19,218 @@ if platform.system() == "Windows":
 else:
     import fcntl
     import pty
+    import select
     import signal
-    import struct
     import termios
 
-from eaf_pyqterm_term import TerminalScreen, TerminalStream
+import eaf_pyqterm_host as host
+from eaf_pyqterm_export import export_chunks
+from eaf_pyqterm_record import Recorder, replay
+from eaf_pyqterm_scrollback import scrollback
+from eaf_pyqterm_session import Session, session_key
+from eaf_pyqterm_term import TerminalScreen, TerminalStream, collapse_overwrites
+from eaf_pyqterm_utils import Notifier
+
+HISTORY_LINES = 99999
+NOTIFY_INTERVAL = 0.05
+WRITE_CHUNK_SIZE = 4096
+# Bounds of the data read from the pty at once, the size grows while the
+# output fills it and shrinks when it doesn't
+READ_SIZE_MIN = 4096
+READ_SIZE_MAX = 262144
+BRACKETED_PASTE_MODE = 2004 << 5  # pyte shifts private modes by 5 bits
+BRACKETED_PASTE_START = "\x1b[200~"
+BRACKETED_PASTE_END = "\x1b[201~"
+# Commands which can change directory once adopted from the pool
+POOL_SHELLS = ("bash", "zsh", "sh", "dash", "ksh", "fish")
+
+
+class LatencyStats:
+    """Keypress-to-write latency of the input path."""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.last = 0.0
+
+    def record(self, latency: float) -> None:
+        self.count += 1
+        self.total += latency
+        self.last = latency
+        if latency > self.max:
+            self.max = latency
+
+    def summary(self) -> str:
+        if self.count == 0:
+            return "No input written yet"
+
+        average = self.total / self.count
+        return (
+            f"Input latency: last {self.last * 1000:.2f}ms, "
+            f"avg {average * 1000:.2f}ms, max {self.max * 1000:.2f}ms "
+            f"({self.count} writes)"
+        )
+
+
+class ForegroundJob:
+    """The foreground process group of a terminal, its name is only read
+    when it changes."""
+
+    def __init__(self, pid, fd=None):
+        self.pid = pid
+        self.fd = fd
+        self.pgid = None
+        self.name = ""
+
+    def read_pgid(self):
+        if self.fd is not None:
+            return os.tcgetpgrp(self.fd)
 
+        # The tpgid field of the stat of the shell, after its command name
+        with open(f"/proc/{self.pid}/stat", "rb") as f:
+            data = f.read()
+        return int(data[data.rindex(b")") + 2 :].split()[5])
 
-class Pty:
+    def update(self):
+        try:
+            pgid = self.read_pgid()
+        except (OSError, ValueError):
+            return
+        if pgid == self.pgid or pgid <= 0:
+            return
+
+        self.pgid = pgid
+        try:
+            with open(f"/proc/{pgid}/comm") as f:
+                self.name = f.read().strip()
+        except OSError:
+            try:
+                self.name = psutil.Process(pgid).name()
+            except:  # noqa: E722
+                self.name = ""
+
+    def getcwd(self):
+        self.update()
+        for pid in (self.pgid, self.pid):
+            if pid is None:
+                continue
+            try:
+                return os.readlink(f"/proc/{pid}/cwd")
+            except OSError:
+                pass
+            try:
+                return psutil.Process(pid).cwd()
+            except:  # noqa: E722
+                pass
+
+
+class QueuedWriter:
+    """Writes which never block the GUI thread: what the fd doesn't take
+    right away is queued and written by the reading thread once the fd is
+    writable, see ``wait_readable``."""
+
+    def init_writer(self, fd):
+        self.write_fd = fd
+        os.set_blocking(fd, False)
+        self.write_queue = deque()
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        os.set_blocking(self.wakeup_w, False)
+        # The fds are -1 once closed, their numbers may be reused by
+        # another terminal right after
+        self.close_lock = threading.Lock()
+
+    def send_bytes(self, data) -> int:
+        return os.write(self.write_fd, data)
+
+    def queue_write(self, data, timestamp=None):
+        """Write ``data``, its latency is recorded from ``timestamp``."""
+        with self.close_lock:
+            if self.wakeup_w == -1:
+                return
+
+            # Keystrokes go out right away, the reading thread may be busy
+            # feeding the screen for a while
+            if not self.write_queue:
+                try:
+                    written = self.send_bytes(data)
+                except BlockingIOError:
+                    written = 0
+                except OSError:
+                    # The child exited, the reading thread closes the pty
+                    return
+                data = data[written:]
+                if not data:
+                    if timestamp is not None:
+                        self.latency.record(time.monotonic() - timestamp)
+                    return
+
+            for i in range(0, len(data), WRITE_CHUNK_SIZE):
+                self.write_queue.append((data[i : i + WRITE_CHUNK_SIZE], timestamp))
+
+            try:
+                os.write(self.wakeup_w, b"\0")
+            except BlockingIOError:
+                # The reading thread has pending wakeups already
+                pass
+
+    def _flush(self):
+        # Under the lock of queue_write, which writes directly to the fd
+        with self.close_lock:
+            if self.wakeup_w == -1:
+                return
+
+            queue = self.write_queue
+            while queue:
+                # Coalesce queued keystrokes into a single write
+                data = b""
+                pending = []
+                while queue and len(data) + len(queue[0][0]) <= WRITE_CHUNK_SIZE:
+                    chunk, timestamp = queue.popleft()
+                    data += chunk
+                    pending.append((len(data), timestamp))
+
+                try:
+                    written = self.send_bytes(data)
+                except BlockingIOError:
+                    written = 0
+
+                now = time.monotonic()
+                for end, timestamp in pending:
+                    if end > written:
+                        queue.appendleft((data[written:], timestamp))
+                        return
+                    if timestamp is not None:
+                        self.latency.record(now - timestamp)
+
+    def wait_readable(self):
+        """Wait until the fd is readable, and write the queue meanwhile."""
+        fd = self.write_fd
+        while True:
+            if self.wakeup_r == -1:
+                raise OSError("Pty closed")
+
+            wlist = [fd] if self.write_queue else []
+            readable, writable, _ = select.select([fd, self.wakeup_r], wlist, [])
+
+            if writable:
+                self._flush()
+            if self.wakeup_r in readable:
+                os.read(self.wakeup_r, 4096)
+            if fd in readable:
+                return
+
+    def close_writer(self):
+        """Close the wakeup pipe, the caller holds ``close_lock``."""
+        os.close(self.wakeup_r)
+        os.close(self.wakeup_w)
+        self.wakeup_r = self.wakeup_w = -1
+
+
+class Pty(QueuedWriter):
     def __init__(self, width, height, argv, start_directory):
+        self.latency = LatencyStats()
+
         env = os.environ
         env.update(
             {
@@ -45,6 +255,15 @@ class Pty:
             self.p_fd = master_fd
             self.p_pid = p_pid
             self.pty = os.fdopen(master_fd, "w+b", 0)
+            self.foreground = ForegroundJob(p_pid, master_fd)
+            self.init_writer(master_fd)
+
+            # Reads go into the same buffer, its data is consumed before
+            # the next read
+            self.read_buffer = memoryview(bytearray(READ_SIZE_MAX))
+            self.read_size = READ_SIZE_MIN
+            # An error after some output is raised by the next read
+            self.read_error = None
 
     def _spawn_winpty(self, env, argv, start_directory):
         self.pty = pty.spawn(
@@ -55,18 +274,71 @@ class Pty:
         )
 
     def read(self):
-        return self.pty.read(65536)
+        if platform.system() == "Windows":
+            return self.pty.read(65536)
+
+        while True:
+            if self.read_error:
+                raise self.read_error
+
+            self.wait_readable()
+            size = self._read_into()
+            if size:
+                return self.read_buffer[:size]
+
+    def _read_into(self):
+        """Read the available output into the buffer, a pty only returns a
+        few KiB per read."""
+        buffer = self.read_buffer
+        size = 0
+        while size < self.read_size:
+            try:
+                count = os.readv(self.p_fd, [buffer[size : self.read_size]])
+            except BlockingIOError:
+                break
+            except OSError as error:
+                # The output read before the child exited is returned first
+                if size:
+                    self.read_error = error
+                    break
+                raise
+            if not count:
+                if size:
+                    break
+                raise OSError("Pty closed")
+            size += count
+
+        if size == self.read_size:
+            self.read_size = min(self.read_size * 2, READ_SIZE_MAX)
+        elif size < self.read_size // 4:
+            self.read_size = max(self.read_size // 2, READ_SIZE_MIN)
+        return size
 
     def write(self, data):
         if platform.system() == "Windows":
+            timestamp = time.monotonic()
             self.pty.write(data.decode())
-        else:
-            self.pty.write(data)
+            self.latency.record(time.monotonic() - timestamp)
+            return
+
+        self.queue_write(data, time.monotonic())
 
     def close(self):
-        self.pty.close()
-        if platform.system() != "Windows":
+        if platform.system() == "Windows":
+            self.pty.close()
+            return
+
+        with self.close_lock:
+            if self.wakeup_w == -1:
+                return
+
+            self.pty.close()
+            self.close_writer()
+
+        try:
             os.kill(self.p_pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
 
     def resize(self, width, height):
         if platform.system() == "Windows":
@@ -86,30 +358,318 @@ class Pty:
     def _resize_winpty(self, width, height):
         self.pty.setwinsize(cols=width, rows=height)
 
+    def adopt(self, width, height, start_directory):
+        """Prepare a shell spawned by the pool for a new terminal."""
+        self.resize(width, height)
+        # A leading space keeps the command out of the history of shells
+        # ignoring space
+        command = f" cd {shlex.quote(start_directory)} && clear\n"
+        self.write(command.encode())
+
     def getcwd(self):
-        pid = self.pty.pid if platform.system() == "Windows" else self.p_pid
+        if platform.system() != "Windows":
+            return self.foreground.getcwd()
+
         try:
-            return psutil.Process(pid).cwd()
+            return psutil.Process(self.pty.pid).cwd()
         except:  # noqa: E722
             pass
 
+    def foreground_name(self):
+        if platform.system() != "Windows":
+            return self.foreground.name
+        return ""
+
+
+class PtyPool:
+    """Shells spawned ahead of time, so a new terminal doesn't wait for the
+    startup of the shell."""
+
+    def __init__(self):
+        self.ptys: dict[tuple, list[Pty]] = {}
+        # Keys being filled, by a single thread each
+        self.filling: set[tuple] = set()
+        self.lock = threading.Lock()
+        atexit.register(self.close)
+
+    def take(self, argv, width, height, start_directory, size):
+        if os.path.basename(argv[0]) not in POOL_SHELLS:
+            return None
+
+        key = tuple(argv)
+        with self.lock:
+            ptys = self.ptys.get(key)
+            spare = ptys.pop(0) if ptys else None
+            fill = key not in self.filling
+            self.filling.add(key)
+
+        if fill:
+            threading.Thread(
+                target=self.fill, args=(argv, width, height, size), daemon=True
+            ).start()
+
+        if spare:
+            spare.adopt(width, height, start_directory)
+        return spare
+
+    def fill(self, argv, width, height, size):
+        key = tuple(argv)
+        try:
+            while True:
+                with self.lock:
+                    ptys = self.ptys.setdefault(key, [])
+                    if len(ptys) >= size:
+                        self.filling.discard(key)
+                        return
+                spare = Pty(width, height, argv, os.path.expanduser("~"))
+                with self.lock:
+                    ptys.append(spare)
+        except OSError:
+            with self.lock:
+                self.filling.discard(key)
+
+    def close(self):
+        with self.lock:
+            for ptys in self.ptys.values():
+                for spare in ptys:
+                    spare.close()
+            self.ptys.clear()
+
+
+pty_pool = PtyPool()
+
+
+class HostPty(QueuedWriter):
+    """Pty of a terminal owned by the host process, see eaf_pyqterm_host."""
 
-class Backend:
     def __init__(self, width, height, argv, start_directory):
-        self.screen = TerminalScreen(False, width, height, 99999)
-        self.buffer_screen = TerminalScreen(True, width, height, 99999)
+        self.latency = LatencyStats()
+        self.detached = False
+        self.received = bytearray()
+
+        self.sock = host.connect(host.socket_path())
+        request = {
+            "key": session_key(argv, start_directory),
+            "argv": argv,
+            "directory": start_directory,
+            "env": {"TERM": "xterm-256color", "COLORTERM": "truecolor"},
+            "columns": width,
+            "lines": height,
+        }
+        try:
+            message_type, payload = self._open(request)
+        except OSError:
+            self.sock.close()
+            raise
+        self.p_pid, attached = host.PID.unpack(payload)
+        self.attached = bool(attached)
+        # The pty is in the host, the foreground is read from /proc
+        self.foreground = ForegroundJob(self.p_pid)
+
+        self.sock.setblocking(False)
+        self.init_writer(self.sock.fileno())
+
+    def _open(self, request):
+        # The host may be busy, it isn't waited for forever
+        self.sock.settimeout(host.CONNECT_TIMEOUT)
+        self.sock.sendall(host.pack(host.OPEN, json.dumps(request).encode()))
+        while True:
+            message = host.unpack(self.received)
+            if message:
+                return message
+
+            data = self.sock.recv(65536)
+            if not data:
+                raise OSError("Host closed")
+            self.received += data
+
+    def send_bytes(self, data) -> int:
+        return self.sock.send(data)
+
+    def _receive(self):
+        while True:
+            message = host.unpack(self.received)
+            if message:
+                return message
+
+            self.wait_readable()
+            try:
+                data = self.sock.recv(65536)
+            except BlockingIOError:
+                continue
+            if not data:
+                raise OSError("Host closed")
+            self.received += data
+
+    def read(self):
+        while True:
+            message_type, payload = self._receive()
+            if message_type == host.EXIT:
+                raise OSError("Pty closed")
+            if message_type == host.OUTPUT and payload:
+                return payload
+
+    def write(self, data):
+        self.queue_write(host.pack(host.INPUT, data), time.monotonic())
+
+    def resize(self, width, height):
+        self.queue_write(host.pack(host.RESIZE, host.SIZE.pack(width, height)))
+
+    def detach(self):
+        """Leave the terminal running in the host."""
+        self.detached = True
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def close(self):
+        with self.close_lock:
+            if self.wakeup_w == -1:
+                return
+
+            if not self.detached:
+                # The queued input and the kill go out before closing, the
+                # host is only waited for a while
+                self.write_queue.append((host.pack(host.KILL), None))
+                self.sock.settimeout(host.CONNECT_TIMEOUT)
+                try:
+                    while self.write_queue:
+                        self.sock.sendall(self.write_queue.popleft()[0])
+                except OSError:
+                    pass
+
+            # Wake up the reading thread
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.sock.close()
+            self.close_writer()
+
+    def getcwd(self):
+        return self.foreground.getcwd()
+
+    def foreground_name(self):
+        return self.foreground.name
+
+
+class Backend:
+    def __init__(
+        self,
+        width,
+        height,
+        argv,
+        start_directory,
+        session_path=None,
+        use_host=False,
+        pool_size=0,
+    ):
+        self.screen = TerminalScreen(False, width, height, HISTORY_LINES)
+        self.buffer_screen = TerminalScreen(True, width, height, HISTORY_LINES)
         self.stream = TerminalStream(self.screen)
         self.buffer_stream = TerminalStream(self.buffer_screen)
 
         self.screen.write_process_input = self.send
         self.buffer_screen.write_process_input = self.send
 
-        self.pty = Pty(width, height, argv, start_directory)
+        self.notifier = Notifier(NOTIFY_INTERVAL)
+        self.screen.notifier = self.notifier
+        self.buffer_screen.notifier = self.notifier
+
+        self.detached = False
+        self.pty = None
+        if use_host and platform.system() != "Windows":
+            try:
+                self.pty = HostPty(width, height, argv, start_directory)
+            except OSError as error:
+                # Shown once the frontend has set the callbacks
+                self.notifier.post(
+                    "host",
+                    lambda text: self.screen.on_message(text),
+                    f"Can't use the host, the terminal won't outlive EAF: {error}",
+                )
+        if not self.pty:
+            if pool_size > 0 and platform.system() != "Windows":
+                self.pty = pty_pool.take(
+                    argv, width, height, start_directory, pool_size
+                )
+            if not self.pty:
+                self.pty = Pty(width, height, argv, start_directory)
         self.getcwd = self.pty.getcwd
+        self.foreground_name = self.pty.foreground_name
+
+        # An attached terminal gets its scrollback from the host
+        self.session = None
+        if not getattr(self.pty, "attached", False):
+            self.session = self.open_session(session_path)
+        if self.session:
+            self.screen.extend_history(self.session.restored_lines())
+            self.screen.session = self.session
+
+        self.recorder = None
+        # The recorder is written by the reading thread, and started and
+        # stopped by the GUI thread
+        self.record_lock = threading.Lock()
+        self.feed_lock = threading.Lock()
+        self.read_bytes = 0
 
         self.thread = threading.Thread(target=self.read)
         self.thread.start()
 
+        scrollback.register(self)
+
+    def set_callbacks(self, **callbacks):
+        """Set the ``on_*`` callbacks of both screens."""
+        for screen in (self.screen, self.buffer_screen):
+            for name, callback in callbacks.items():
+                setattr(screen, f"on_{name}", callback)
+
+    def set_triggers(self, triggers):
+        for screen in (self.screen, self.buffer_screen):
+            screen.triggers = triggers
+
+    def enable_overview(self):
+        screen = self.buffer_screen if self.screen.is_buffer else self.screen
+        with self.feed_lock:
+            screen.enable_overview()
+
+    def close_buffer(self):
+        """Called when the terminal exits, replaced by the buffer."""
+
+    def open_session(self, path):
+        if not path:
+            return None
+
+        # Another terminal of the same command and directory may own the
+        # session, then fall back to a numbered one.
+        for i in range(16):
+            try:
+                return Session(f"{path}-{i}" if i else path, HISTORY_LINES)
+            except BlockingIOError:
+                continue
+            except (OSError, ValueError):
+                return None
+
+    def save_session(self):
+        # The reading thread appends the history to the session
+        with self.feed_lock:
+            session = self.session
+            if not session:
+                return
+
+            # The screen contents are part of the scrollback of next time,
+            # unless saving the history failed
+            screen = self.buffer_screen if self.screen.is_buffer else self.screen
+            try:
+                if screen.session is session:
+                    for y in range(screen.get_last_blank_line()):
+                        session.append_line(screen.buffer[y])
+                session.close()
+            except (OSError, ValueError, struct.error):
+                pass
+            self.session = screen.session = None
+
     def title(self):
         return self.screen.title or self.buffer_screen.title
 
@@ -148,23 +708,105 @@ class Backend:
         self.buffer_screen.reset()
         self.screen.dirty.update(range(self.screen.lines))
 
+    def feed(self, data: bytes):
+        # Output of the pty and replays can be fed at the same time
+        with self.feed_lock:
+            # The data may switch to the other screen
+            if self.stream.can_collapse() and self.buffer_stream.can_collapse():
+                data = collapse_overwrites(data, self.screen.columns)
+            self.write_to_screen(data)
+
     def read(self):
-        if platform.system() == "Windows":
-            while True:
-                try:
-                    data = self.pty.read().encode()
-                    self.write_to_screen(data)
-                except (OSError, IOError):
+        while True:
+            try:
+                data = self.pty.read()
+                if platform.system() == "Windows":
+                    data = data.encode()
+            except (OSError, IOError):
+                if not self.detached:
                     self.close()
-                    break
-        else:
-            while True:
+                break
+
+            self.read_bytes += len(data)
+            if self.recorder:
+                self.record(data)
+            # The parser needs bytes, data may be a view of the read buffer
+            self.feed(bytes(data))
+
+    def record(self, data):
+        with self.record_lock:
+            if not self.recorder:
+                return
+            try:
+                self.recorder.write(data)
+            except (OSError, ValueError):
+                # A failed recording must not stop the terminal
+                recorder, self.recorder = self.recorder, None
                 try:
-                    data = self.pty.read()
-                    self.write_to_screen(data)
-                except (OSError, IOError):
-                    self.close()
-                    break
+                    recorder.close()
+                except OSError:
+                    pass
+
+    def start_recording(self, path: str):
+        recorder = Recorder(path)
+        with self.record_lock:
+            recorder, self.recorder = self.recorder, recorder
+        if recorder:
+            recorder.close()
+
+    def stop_recording(self):
+        with self.record_lock:
+            recorder, self.recorder = self.recorder, None
+        if recorder:
+            try:
+                recorder.close()
+            except OSError:
+                pass
+
+    def replay(self, path: str, realtime: bool, callback):
+        """Replay a recording in a thread, ``callback`` is called with the
+        size and seconds of the replay."""
+
+        def run():
+            try:
+                result = replay(path, self.feed, realtime)
+            except Exception as error:
+                self.screen.on_message(f"Replay of {path} failed: {error}")
+                return
+            callback(*result)
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def export(
+        self,
+        start,
+        end,
+        write,
+        export_format: str,
+        color_map: dict,
+        callback,
+        close=None,
+    ):
+        """Export the lines from ``start`` to ``end`` with ``write`` in
+        chunks in a thread, then call ``close`` if any. ``callback`` is
+        called with the line count, errors are reported as messages."""
+        with self.feed_lock:
+            lines = self.screen.get_lines(start, end)
+
+        def run():
+            try:
+                try:
+                    for chunk in export_chunks(lines, export_format, color_map):
+                        write(chunk)
+                finally:
+                    if close:
+                        close()
+            except (OSError, UnicodeError) as error:
+                self.screen.on_message(f"Export failed: {error}")
+                return
+            callback(len(lines))
+
+        threading.Thread(target=run, daemon=True).start()
 
     def send(self, data: str):
         try:
@@ -172,7 +814,40 @@ class Backend:
         except:  # noqa: E722
             self.close()
 
+    def paste(self, text: str):
+        if BRACKETED_PASTE_MODE in self.screen.mode:
+            # Pasted text must not be able to end the bracketed paste itself
+            text = text.replace(BRACKETED_PASTE_END, "")
+            text = BRACKETED_PASTE_START + text + BRACKETED_PASTE_END
+
+        # Pty.write splits the data into chunks and writes them when the
+        # child is ready to read, so a large paste never blocks.
+        self.send(text)
+
+    def is_hosted(self):
+        """Whether the terminal runs in the host, and can be detached."""
+        return isinstance(self.pty, HostPty)
+
+    def detach(self):
+        """Close the buffer and leave the terminal running in the host."""
+        self.detached = True
+        self.stop_recording()
+        scrollback.unregister(self)
+
+        # The screen is still alive, it isn't part of the scrollback
+        with self.feed_lock:
+            session, self.session = self.session, None
+            if session:
+                self.screen.session = self.buffer_screen.session = None
+                session.close()
+
+        self.pty.detach()
+        self.pty.close()
+
     def close(self):
+        self.stop_recording()
+        scrollback.unregister(self)
+        self.save_session()
         self.pty.close()
         self.close_buffer()
 
@@ -36,6 +36,16 @@ class AppBuffer(Buffer):
         self.add_widget(self.term)
         self.build_all_methods(self.term)
 
+    def destroy_buffer(self):
+        if self.term.backend.is_hosted():
+            # The terminal keeps running, the next one of the same command
+            # and directory attaches to it.
+            if not self.term.backend.detached:
+                self.term.backend.detach()
+        else:
+            self.term.backend.save_session()
+        super().destroy_buffer()
+
     @interactive
     def update_theme(self):
         super().update_theme()
@@ -0,0 +1,166 @@
+# Copyright (C) 2023 by Mumulhl <mumulhl@duck.com>
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+"""Export of terminal lines as plain text, ANSI or HTML.
+
+The output is generated in chunks, so exporting a big scrollback never
+builds the whole text in memory.
+"""
+
+import html
+from typing import Iterable, Iterator
+
+from pyte import graphics as g
+from pyte.screens import Char
+
+CHUNK_SIZE = 65536
+DEFAULT_STYLE = Char(" ")[1:]
+
+FG_CODES = {name: code for code, name in {**g.FG_ANSI, **g.FG_AIXTERM}.items()}
+BG_CODES = {name: code for code, name in {**g.BG_ANSI, **g.BG_AIXTERM}.items()}
+
+HTML_HEADER = '<pre style="color: {}; background: {}">\n'
+HTML_FOOTER = "</pre>\n"
+
+
+def get_export_format(path: str) -> str:
+    if path.endswith((".html", ".htm")):
+        return "html"
+    if path.endswith(".ansi"):
+        return "ansi"
+    return "text"
+
+
+def split_line(line, start: int, end: int) -> tuple[list, str]:
+    """Return the runs of ``(char, text)`` of the same style and the line
+    end, lines without trailing blanks are wrapped and don't end with a
+    newline."""
+    runs = []
+    for x in range(start, end):
+        char = line[x]
+        if runs and runs[-1][0][1:] == char[1:]:
+            runs[-1][1].append(char.data)
+        else:
+            runs.append((char, [char.data]))
+    runs = [(char, "".join(text)) for char, text in runs]
+
+    if not runs or not runs[-1][1].endswith(" "):
+        return runs, ""
+
+    # Drop trailing blanks
+    while runs:
+        char, text = runs[-1]
+        text = text.rstrip(" ")
+        if text:
+            runs[-1] = (char, text)
+            break
+        runs.pop()
+    return runs, "\n"
+
+
+def text_line(line, start: int, end: int) -> str:
+    runs, newline = split_line(line, start, end)
+    return "".join(text for _, text in runs) + newline
+
+
+def sgr(char) -> str:
+    codes = ["0"]
+    for attribute, code in (
+        ("bold", "1"),
+        ("italics", "3"),
+        ("underscore", "4"),
+        ("blink", "5"),
+        ("reverse", "7"),
+        ("strikethrough", "9"),
+    ):
+        if getattr(char, attribute):
+            codes.append(code)
+
+    for color, names, prefix in ((char.fg, FG_CODES, 38), (char.bg, BG_CODES, 48)):
+        if color == "default":
+            continue
+        if color in names:
+            codes.append(str(names[color]))
+        else:
+            rgb = (int(color[i : i + 2], 16) for i in (0, 2, 4))
+            codes.append(f"{prefix};2;" + ";".join(map(str, rgb)))
+
+    return "\x1b[" + ";".join(codes) + "m"
+
+
+def ansi_line(line, start: int, end: int) -> str:
+    runs, newline = split_line(line, start, end)
+
+    parts = []
+    styled = False
+    for char, text in runs:
+        # Only reset a default run after a styled one
+        if styled or char[1:] != DEFAULT_STYLE:
+            parts.append(sgr(char))
+            styled = char[1:] != DEFAULT_STYLE
+        parts.append(text)
+    if styled:
+        parts.append("\x1b[0m")
+
+    return "".join(parts) + newline
+
+
+def html_line(line, start: int, end: int, color_map: dict[str, str]) -> str:
+    runs, newline = split_line(line, start, end)
+
+    spans = []
+    for char, text in runs:
+        if char[1:] == DEFAULT_STYLE:
+            spans.append(html.escape(text))
+            continue
+
+        fg = "white" if char.fg == "default" else char.fg
+        bg = "black" if char.bg == "default" else char.bg
+        if char.reverse:
+            fg, bg = bg, fg
+
+        style = [f"color: {color_map.get(fg) or '#' + fg}"]
+        if bg != "black":
+            style.append(f"background: {color_map.get(bg) or '#' + bg}")
+        if char.bold:
+            style.append("font-weight: bold")
+        if char.italics:
+            style.append("font-style: italic")
+        if char.underscore or char.strikethrough:
+            decoration = "underline" if char.underscore else "line-through"
+            style.append(f"text-decoration: {decoration}")
+
+        spans.append(f'<span style="{"; ".join(style)}">{html.escape(text)}</span>')
+
+    return "".join(spans) + newline
+
+
+def export_chunks(
+    lines: Iterable[tuple], export_format: str, color_map: dict[str, str] = {}
+) -> Iterator[str]:
+    """Export ``lines`` of ``(line, start, end)`` in chunks of text."""
+    if export_format == "html":
+        yield HTML_HEADER.format(color_map.get("white"), color_map.get("black"))
+
+    chunk = []
+    size = 0
+    for line, start, end in lines:
+        if export_format == "html":
+            text = html_line(line, start, end, color_map)
+        elif export_format == "ansi":
+            text = ansi_line(line, start, end)
+        else:
+            text = text_line(line, start, end)
+
+        chunk.append(text)
+        size += len(text)
+        if size >= CHUNK_SIZE:
+            yield "".join(chunk)
+            chunk = []
+            size = 0
+
+    if chunk:
+        yield "".join(chunk)
+
+    if export_format == "html":
+        yield HTML_FOOTER
@@ -2,6 +2,7 @@
 # SPDX-License-Identifier: GPL-3.0-or-later
 
 import math
+import os
 import time
 from enum import Enum
 
@@ -20,11 +21,16 @@ from PyQt6.QtGui import (
     QPixmap,
     QWheelEvent,
 )
-from PyQt6.QtWidgets import QWidget
+from PyQt6.QtWidgets import QApplication, QWidget
 from pyte.screens import Cursor
 
 import eaf_pyqterm_backend as backend
-from eaf_pyqterm_utils import generate_random_key, match_link
+from eaf_pyqterm_export import get_export_format
+from eaf_pyqterm_minimap import line_summary
+from eaf_pyqterm_scrollback import scrollback
+from eaf_pyqterm_session import session_path
+from eaf_pyqterm_trigger import Triggers
+from eaf_pyqterm_utils import generate_random_key, get_link, is_wide, match_link
 
 CSI_C0 = pyte.control.CSI_C0
 KEY_DICT = {
@@ -44,10 +50,61 @@ KEY_DICT = {
 
 align = Qt.AlignmentFlag.AlignBottom | Qt.AlignmentFlag.AlignLeft
 
+FLOOD_SAMPLE_SECONDS = 0.5
+# Lines per second for every line the pointer is outside of the terminal
+AUTO_SCROLL_SPEED = 20
+TRIGGER_MARK_WIDTH = 3
+# Minimum interval between two drawings of the minimap
+MINIMAP_INTERVAL = 0.5
+
 LineType = Enum("LineType", ("Underline", "StrikeOut"))
 StyleType = Enum("StyleType", ("Bold", "Italics", "Underline", "StrikeOut"))
 
 
+class PaintBatch:
+    """Drawing of a frame grouped by color and font, submitted once the
+    dirty lines are collected so the painter state changes once per group
+    instead of once per run."""
+
+    def __init__(self):
+        self.backgrounds: dict[str, list[QRectF]] = {}
+        self.texts: dict[tuple, list[tuple[QRectF, str]]] = {}
+        self.lines: dict[str, list[QLineF]] = {}
+        # Drawn over the text
+        self.marks: dict[str, list[QRectF]] = {}
+
+    def fill(self, color: str, rect: QRectF):
+        rects = self.backgrounds.setdefault(color, [])
+        # Join runs with the same background
+        if rects:
+            last = rects[-1]
+            if last.top() == rect.top() and last.right() == rect.left():
+                last.setRight(rect.right())
+                return
+        rects.append(rect)
+
+    def submit(self, painter: QPainter, get_font):
+        for color, rects in self.backgrounds.items():
+            color = QColor(color)
+            for rect in rects:
+                painter.fillRect(rect, color)
+
+        for (color, style), texts in self.texts.items():
+            painter.setFont(get_font(list(style)))
+            painter.setPen(QColor(color))
+            for rect, text in texts:
+                painter.drawText(rect, align, text)
+
+        for color, lines in self.lines.items():
+            painter.setPen(QColor(color))
+            painter.drawLines(lines)
+
+        for color, rects in self.marks.items():
+            color = QColor(color)
+            for rect in rects:
+                painter.fillRect(rect, color)
+
+
 class FrontendWidget(QWidget):
     color_map = {}
     fonts = {}
@@ -64,6 +121,16 @@ class FrontendWidget(QWidget):
             self.cursor_alpha,
             self.device_pixel_ratio,
             self.marker_letters,
+            self.session_directory,
+            self.flood_threshold,
+            self.flood_refresh_ms,
+            self.notify_interval_ms,
+            self.cursor_blink_ms,
+            self.use_host,
+            self.pool_size,
+            self.scrollback_budget,
+            triggers,
+            self.minimap_width,
         ) = get_emacs_vars(
             (
                 "eaf-pyqterminal-font-size",
@@ -74,6 +141,16 @@ class FrontendWidget(QWidget):
                 "eaf-pyqterminal-cursor-alpha",
                 "eaf-pyqterminal-device-pixel-ratio",
                 "eaf-marker-letters",
+                "eaf-pyqterminal-session-directory",
+                "eaf-pyqterminal-flood-threshold",
+                "eaf-pyqterminal-flood-refresh-ms",
+                "eaf-pyqterminal-notify-interval-ms",
+                "eaf-pyqterminal-cursor-blink-ms",
+                "eaf-pyqterminal-use-host",
+                "eaf-pyqterminal-pool-size",
+                "eaf-pyqterminal-scrollback-budget",
+                "eaf-pyqterminal-triggers",
+                "eaf-pyqterminal-minimap-width",
             )
         )
 
@@ -83,17 +160,37 @@ class FrontendWidget(QWidget):
 
         self.init_color_schema()
 
-        self.directory = ""
-        self.title = ""
-
         self.link_markers: dict[str, str] = {}
-        self.link_markers_position: list[int] = []
+        self.link_marker_rects: list[tuple[QRectF, str]] = []
 
         self.last_mouse_click_time = 0
         self.last_mouse_click_position = (0, 0)
         self.first_mouse_move = True
 
+        # Lines per second, negative is up
+        self.auto_scroll_speed = 0.0
+        self.auto_scroll_lines = 0.0
+        self.last_auto_scroll_time = 0
+
+        # The cursor and the selection are drawn over the pixmap of text,
+        # so moving them never repaints text.
         self.cursor = Cursor(0, 0)
+        self.cursor_blink_on = True
+        self.last_blink_time = 0
+        self.marker = ()
+        self.selection: dict[int, range] = {}
+
+        # The minimap is drawn again when the history changed, its view
+        # of the screen is drawn over it
+        self.minimap = None
+        self.minimap_version = None
+        self.minimap_time = 0
+        self.minimap_dragging = False
+
+        self.flood_mode = False
+        self.flood_sample_time = time.time()
+        self.flood_sample_bytes = 0
+        self.last_paint_time = 0
 
         font = QFont()
         font.setFamily(self.font_family)
@@ -106,12 +203,48 @@ class FrontendWidget(QWidget):
         self.columns, self.rows = self.pixel_to_position(screen.size().width(), screen.size().height())
         self.underline_pos = fm.underlinePos()
 
-        self.backend = backend.Backend(self.columns, self.rows, argv, start_directory)
+        self.backend = backend.Backend(
+            self.columns,
+            self.rows,
+            argv,
+            start_directory,
+            self.session_directory
+            and session_path(self.session_directory, argv, start_directory),
+            self.use_host,
+            self.pool_size,
+        )
+
+        self.backend.notifier.interval = self.notify_interval_ms / 1000
+        self.backend.set_callbacks(
+            bell=QApplication.beep,
+            message=message_to_emacs,
+            clipboard=set_clipboard_text,
+            cursor_move_mode=self.toggle_emacs_cursor_move_mode,
+            trigger=self.notify_trigger,
+        )
+        self.init_triggers(triggers or [])
+        scrollback.budget = self.scrollback_budget
+        if self.minimap_width > 0:
+            self.backend.enable_overview()
 
         self.init_pixmap()
 
         self.startTimer(self.refresh_ms)
 
+    def toggle_emacs_cursor_move_mode(self, status: bool):
+        eval_in_emacs("eaf--toggle-cursor-move-mode", ["'t" if status else "'nil"])
+
+    def init_triggers(self, triggers):
+        triggers = Triggers([(name, pattern) for name, pattern in triggers])
+        if triggers.errors:
+            message_to_emacs(f"Invalid trigger patterns: {', '.join(triggers.errors)}")
+        if triggers.names:
+            self.backend.set_triggers(triggers)
+
+    def notify_trigger(self, name: str, text: str, line_num: int):
+        # Firings are told apart by their line, Emacs only gets the text
+        eval_in_emacs("eaf--pyqterminal-trigger", [self.buffer_id, name, text])
+
     def ensure_font_exist(self):
         """Use system Mono font if user's font is not exist."""
         if self.font_family not in QFontDatabase.families():
@@ -165,24 +298,26 @@ class FrontendWidget(QWidget):
 
     def paint_text(self, painter: QPainter):
         screen = self.backend.screen
-
-        # Redraw the old and new cursor's line
-        screen.dirty.update([self.cursor.y, screen.get_cursor().y])
+        batch = PaintBatch()
 
         # Dirty will change when traversing
         while screen.dirty:
             y = screen.dirty.pop()
-            self.paint_text_of_line(painter, y)
+            self.paint_text_of_line(batch, y)
+
+        batch.submit(painter, self.get_font)
+
+    def get_color(self, name: str) -> str:
+        return self.color_map.get(name) or "#" + name
 
     def draw_text(
         self,
-        painter: QPainter,
+        batch: PaintBatch,
         text: str,
         text_width: float,
         pre_char: pyte.screens.Char,
         start_x: float,
         start_y: float,
-        is_selection: bool,
     ):
         fg = pre_char.fg
         bg = pre_char.bg
@@ -196,10 +331,6 @@ class FrontendWidget(QWidget):
         if pre_char.reverse:
             fg, bg = bg, fg
 
-        if is_selection:
-            fg = "black"
-            bg = "white"
-
         style = []
         if pre_char.bold:
             style.append(StyleType.Bold)
@@ -207,20 +338,23 @@ class FrontendWidget(QWidget):
             style.append(StyleType.Italics)
 
         rect = QRectF(start_x, start_y, text_width, self.char_height)
-        painter.fillRect(rect, QColor(self.color_map.get(bg) or "#" + bg))
+        # The line is already cleared with the default background
+        bg = self.get_color(bg)
+        if bg != self.color_map["black"]:
+            batch.fill(bg, QRectF(rect))
 
-        painter.setFont(self.get_font(style))
-        painter.setPen(QColor(self.color_map.get(fg) or "#" + fg))
-        painter.drawText(rect, align, text)
+        fg = self.get_color(fg)
+        batch.texts.setdefault((fg, tuple(style)), []).append((rect, text))
 
         if pre_char.underscore:
-            self.draw_line(painter, start_x, start_y, text_width, LineType.Underline)
+            self.draw_line(batch, fg, start_x, start_y, text_width, LineType.Underline)
         if pre_char.strikethrough:
-            self.draw_line(painter, start_x, start_y, text_width, LineType.StrikeOut)
+            self.draw_line(batch, fg, start_x, start_y, text_width, LineType.StrikeOut)
 
     def draw_line(
         self,
-        painter: QPainter,
+        batch: PaintBatch,
+        color: str,
         start_x: float,
         start_y: float,
         width: float,
@@ -228,30 +362,21 @@ class FrontendWidget(QWidget):
     ):
         if line_type == LineType.Underline:
             start_y += self.char_height - self.underline_pos
-            line = QLineF(start_x, start_y, start_x + width, start_y)
-            painter.drawLine(line)
         elif line_type == LineType.StrikeOut:
             start_y += self.char_height / 2
-            line = QLineF(start_x, start_y, start_x + width, start_y)
-            painter.drawLine(line)
+        line = QLineF(start_x, start_y, start_x + width, start_y)
+        batch.lines.setdefault(color, []).append(line)
 
     def can_draw_together(
         self,
         pre_char: pyte.screens.Char,
         char: pyte.screens.Char,
-        is_selection: bool,
-        pre_is_selection: bool,
         is_two_width: bool,
     ) -> bool:
-        is_fg_same = True if pre_is_selection else pre_char.fg == char.fg
-        is_bg_same = True if pre_is_selection else pre_char.bg == char.bg
-
         return (
-            is_fg_same
-            and is_bg_same
+            pre_char.fg == char.fg
+            and pre_char.bg == char.bg
             and not is_two_width
-            and not pre_is_selection
-            and pre_is_selection == is_selection
             and pre_char.reverse == char.reverse
             and pre_char.bold == char.bold
             and pre_char.italics == char.italics
@@ -259,11 +384,11 @@ class FrontendWidget(QWidget):
             and pre_char.strikethrough == char.strikethrough
         )
 
-    def clear_line(self, painter: QPainter, y: float):
+    def clear_line(self, batch: PaintBatch, y: float):
         clear_rect = QRectF(0, y, self.width(), self.char_height)
-        painter.fillRect(clear_rect, QColor(self.color_map["black"]))
+        batch.backgrounds.setdefault(self.color_map["black"], []).append(clear_rect)
 
-    def paint_text_of_line(self, painter: QPainter, row: int):
+    def paint_text_of_line(self, batch: PaintBatch, row: int):
         if row >= self.rows:
             return
 
@@ -276,14 +401,12 @@ class FrontendWidget(QWidget):
         screen = self.backend.screen
         line = screen.get_line(row)
 
-        selection = screen.get_selection(row)
         is_two_width = True
         same_text = ""
 
         pre_char = pyte.screens.Char("")
-        pre_is_selection = 0 in selection
 
-        self.clear_line(painter, y)
+        self.clear_line(batch, y)
 
         text_width = 0
         for column in range(screen.columns + 1):
@@ -294,51 +417,50 @@ class FrontendWidget(QWidget):
                 if char.data == "":
                     continue
 
-                is_selection = column in selection
-                is_two_width = line[column + 1].data == ""
+                is_two_width = is_wide(line, column)
 
-                if self.can_draw_together(
-                    pre_char,
-                    char,
-                    is_selection,
-                    pre_is_selection,
-                    is_two_width,
-                ):
+                if self.can_draw_together(pre_char, char, is_two_width):
                     same_text += char.data
                     continue
 
-            self.draw_text(
-                painter,
-                same_text,
-                text_width,
-                pre_char,
-                x,
-                y,
-                pre_is_selection,
-            )
+            self.draw_text(batch, same_text, text_width, pre_char, x, y)
             if column != 0:
                 x += text_width
             text_width = 0
 
             pre_char = char
             same_text = char.data
-            pre_is_selection = is_selection
+
+        if screen.triggers and screen.is_trigger_line(row):
+            mark = QRectF(0, y, TRIGGER_MARK_WIDTH, char_height)
+            batch.marks.setdefault(self.color_map["red"], []).append(mark)
 
         if row == self.rows - 1:
             y += char_height
-            self.clear_line(painter, y)
+            self.clear_line(batch, y)
+
+    def cursor_rect(self) -> QRectF:
+        cursor = self.cursor
+        line = self.backend.screen.get_line(cursor.y)
+        cursor_width = 2 if is_wide(line, cursor.x) else 1
+        return QRectF(
+            cursor.x * self.char_width,
+            cursor.y * self.char_height,
+            cursor_width * self.char_width,
+            self.char_height,
+        )
 
     def paint_cursor(self, painter: QPainter):
         screen = self.backend.screen
-        cursor = screen.get_cursor()
+        cursor = self.cursor
 
-        if cursor.hidden or (screen.in_history and not screen.cursor_move_mode):
+        if (
+            cursor.hidden
+            or not self.cursor_blink_on
+            or (screen.in_history and not screen.cursor_move_mode)
+        ):
             return
 
-        self.cursor.x = cursor.x
-        self.cursor.y = cursor.y
-        self.cursor.hidden = cursor.hidden
-
         line = screen.get_line(cursor.y)
         cursor_x = 0
         cursor_y = cursor.y * self.char_height
@@ -348,7 +470,7 @@ class FrontendWidget(QWidget):
         cursor_height = self.char_height
         cursor_alpha = self.cursor_alpha
         cursor_width = (
-            self.char_width * 2 if line[cursor.x + 1].data == "" else self.char_width
+            self.char_width * 2 if is_wide(line, cursor.x) else self.char_width
         )
         if (
             self.cursor_type == "box"
@@ -374,10 +496,67 @@ class FrontendWidget(QWidget):
         painter.setBrush(brush)
         painter.drawRect(QRectF(cursor_x, cursor_y, cursor_width, cursor_height))
 
+    def paint_selection(self, painter: QPainter):
+        base = self.backend.screen.base
+
+        painter.setPen(QColor(self.color_map["black"]))
+        for y, selection in self.selection.items():
+            self.paint_selection_of_line(painter, y - base, selection)
+
+    def paint_selection_of_line(self, painter: QPainter, row: int, selection: range):
+        line = self.backend.screen.get_line(row)
+        y = row * self.char_height
+
+        rect = QRectF(
+            selection.start * self.char_width,
+            y,
+            len(selection) * self.char_width,
+            self.char_height,
+        )
+        painter.fillRect(rect, QColor(self.color_map["white"]))
+
+        # Draw the selected text again in runs of the same font
+        start = selection.start
+        text = ""
+        for column in range(selection.start, selection.stop + 1):
+            char = line[column]
+            if column < selection.stop:
+                if char.data == "":
+                    continue
+                pre_char = line[start]
+                if (
+                    char.bold == pre_char.bold
+                    and char.italics == pre_char.italics
+                    and not is_wide(line, start)
+                    and not is_wide(line, column)
+                ):
+                    text += char.data
+                    continue
+
+            if text:
+                style = []
+                if line[start].bold:
+                    style.append(StyleType.Bold)
+                if line[start].italics:
+                    style.append(StyleType.Italics)
+                painter.setFont(self.get_font(style))
+                width = (column - start) * self.char_width
+                rect = QRectF(start * self.char_width, y, width, self.char_height)
+                painter.drawText(rect, align, text)
+
+            start = column
+            text = char.data
+
+    def paint_link_markers(self, painter: QPainter):
+        painter.setFont(self.font)
+        painter.setPen(QColor(self.color_map["black"]))
+        for rect, marker in self.link_marker_rects:
+            painter.fillRect(rect, QColor(self.color_map["yellow"]))
+            painter.drawText(rect, align, marker)
+
     def paint_pixmap(self):
         painter = QPainter(self.pixmap)
         self.paint_text(painter)
-        self.paint_cursor(painter)
 
     def get_text_width(self, text: str, is_two_width: bool = False) -> float:
         if is_two_width:
@@ -392,6 +571,18 @@ class FrontendWidget(QWidget):
     def handle_input_response(self, callback_tag: str, result_content: str):
         if callback_tag == "open_link":
             self._open_link(result_content)
+        elif callback_tag == "start_recording":
+            self._start_recording(result_content)
+        elif callback_tag == "replay_recording":
+            self._replay_recording(result_content, True)
+        elif callback_tag == "replay_recording_fast":
+            self._replay_recording(result_content, False)
+        elif callback_tag == "export_selection":
+            self._export(result_content, "selection")
+        elif callback_tag == "export_history":
+            self._export(result_content, "history")
+        elif callback_tag == "export_last_output":
+            self._export(result_content, "last_output")
 
     @PostGui()
     def cancel_input_response(self, callback_tag: str):
@@ -403,8 +594,7 @@ class FrontendWidget(QWidget):
         return list(map(lambda key: key.lower(), key_list))
 
     def render_marker(self, markers: dict[str, dict[str, str]]):
-        painter = QPainter(self.pixmap)
-        painter.setPen(QColor(self.color_map["black"]))
+        self.link_marker_rects = []
         for y, markers in markers.items():
             line = self.backend.screen.get_line(y)
             x_position, y_position = 0, y * self.char_height
@@ -414,7 +604,7 @@ class FrontendWidget(QWidget):
                 if char == "":
                     continue
                 x_display += 1
-                x_position += self.get_text_width(char, line[x + 1].data == "")
+                x_position += self.get_text_width(char, is_wide(line, x))
 
                 marker = markers.get(0 if x == 0 else x_display)
                 if marker:
@@ -424,9 +614,9 @@ class FrontendWidget(QWidget):
                         self.get_text_width(marker),
                         self.char_height,
                     )
-                    painter.fillRect(rect, QColor(self.color_map["yellow"]))
-                    painter.drawText(rect, align, marker)
-                    self.update()
+                    self.link_marker_rects.append((rect, marker))
+
+        self.update()
 
     def get_link_markers(self):
         text = ""
@@ -470,20 +660,17 @@ class FrontendWidget(QWidget):
                     line_down_number = x // self.columns
                     x -= line_down_number * self.columns
                     y += line_down_number
-                    markers[y].update({x: key})
-                    count += 1
-                    self.link_markers_position = list(markers.keys())
+                    markers.setdefault(y, {})
+                markers[y].update({x: key})
+                count += 1
 
         self.render_marker(markers)
 
     @PostGui()
     def cleanup_link_markers(self):
         self.link_markers = {}
-        # Doing so because can't direct update screen dirty
-        painter = QPainter(self.pixmap)
-        for y in self.link_markers_position:
-            self.paint_text_of_line(painter, y)
-            self.update()
+        self.link_marker_rects = []
+        self.update()
 
     def _open_link(self, marker: str):
         link = self.link_markers.get(marker.upper())
@@ -491,12 +678,83 @@ class FrontendWidget(QWidget):
             open_url_in_new_tab(link)
             self.cleanup_link_markers()
 
+    def _start_recording(self, path: str):
+        path = os.path.expanduser(path)
+        try:
+            self.backend.start_recording(path)
+        except OSError as e:
+            message_to_emacs(f"Can't record to {path}: {e.strerror}")
+            return
+        message_to_emacs(f"Recording to {path}")
+
+    def _replay_recording(self, path: str, realtime: bool):
+        path = os.path.expanduser(path)
+        if not os.path.isfile(path):
+            message_to_emacs(f"No recording {path}")
+            return
+
+        def callback(size: int, seconds: float):
+            speed = size / seconds / 1024 / 1024 if seconds else 0
+            message_to_emacs(
+                f"Replayed {size} bytes in {seconds:.2f}s ({speed:.2f} MiB/s)"
+            )
+
+        self.backend.replay(path, realtime, callback)
+
+    def _export(self, destination: str, thing: str):
+        """Export to a file, or to an Emacs buffer if ``destination`` is a
+        name like ``*export*``."""
+        screen = self.backend.screen
+        if thing == "selection":
+            if screen.marker == ():
+                message_to_emacs("Nothing selected")
+                return
+            start, end = screen.get_selection_range()
+        elif thing == "last_output":
+            selection = screen.get_last_output_range()
+            if selection is None:
+                message_to_emacs("No command output")
+                return
+            start, end = selection
+        else:
+            start, end = screen.get_history_range()
+
+        if len(destination) > 2 and destination[0] == destination[-1] == "*":
+            eval_in_emacs("eaf--pyqterminal-export-begin", [destination])
+
+            def write(chunk: str):
+                eval_in_emacs("eaf--pyqterminal-export-insert", [destination, chunk])
+
+            close = None
+            export_format = "text"
+        else:
+            destination = os.path.expanduser(destination)
+            try:
+                f = open(destination, "w", encoding="utf-8")
+            except OSError as e:
+                message_to_emacs(f"Can't export to {destination}: {e.strerror}")
+                return
+
+            write, close = f.write, f.close
+            export_format = get_export_format(destination)
+
+        def callback(line_num: int):
+            message_to_emacs(f"Exported {line_num} lines to {destination}")
+
+        self.backend.export(
+            start, end, write, export_format, self.color_map, callback, close
+        )
+
     def get_cursor_absolute_position(self) -> tuple[int, int]:
         pos = self.mapFromGlobal(QCursor.pos())
         return pos.x(), pos.y()
 
+    def text_area_width(self) -> int:
+        """Width left of the space of the minimap."""
+        return self.width() - max(self.minimap_width, 0)
+
     def resize_view(self):
-        width = self.width()
+        width = self.text_area_width()
         height = self.height()
 
         self.columns, self.rows = self.pixel_to_position(width, height)
@@ -504,47 +762,281 @@ class FrontendWidget(QWidget):
 
         self.init_pixmap()
         self.paint_pixmap()
+        self.minimap_version = None
+
+    def paint_flood_indicator(self, painter: QPainter):
+        text = " Flood "
+        # Next to the minimap rather than over it
+        rect = QRectF(
+            self.text_area_width() - self.get_text_width(text),
+            0,
+            self.get_text_width(text),
+            self.char_height,
+        )
+        painter.fillRect(rect, QColor(self.color_map["yellow"]))
+        painter.setPen(QColor(self.color_map["black"]))
+        painter.setFont(self.font)
+        painter.drawText(rect, align, text)
+
+    def has_minimap(self) -> bool:
+        screen = self.backend.screen
+        return screen.overview is not None and not screen.is_buffer
+
+    def minimap_lines(self) -> int:
+        return len(self.backend.screen.history.top) + self.rows
+
+    def update_minimap(self, now: float):
+        screen = self.backend.screen
+        if not self.has_minimap():
+            return
+
+        version = (
+            screen.overview.version,
+            screen.history_dropped,
+            len(screen.prompt_marks["A"]),
+            len(screen.trigger_lines),
+            self.rows,
+        )
+        if (
+            version == self.minimap_version
+            or now - self.minimap_time < MINIMAP_INTERVAL
+        ):
+            return
+        self.minimap_version = version
+        self.minimap_time = now
+
+        with self.backend.feed_lock:
+            self.paint_minimap_pixmap()
+        self.update(self.minimap_rect().toAlignedRect())
+
+    def paint_minimap_pixmap(self):
+        """Draw a row of pixels for every few lines, as long as their
+        longest line and in one of their colors."""
+        screen = self.backend.screen
+        overview = screen.overview
+        width = self.minimap_width
+        height = self.height()
+
+        self.minimap = QPixmap(
+            width * self.device_pixel_ratio, height * self.device_pixel_ratio
+        )
+        self.minimap.setDevicePixelRatio(self.device_pixel_ratio)
+        self.minimap.fill(QColor(self.color_map["black"]))
+
+        history_length = len(screen.history.top)
+        total = history_length + self.rows
+        screen_lines = [
+            line_summary(screen.buffer[y]) for y in range(min(screen.lines, self.rows))
+        ]
+
+        rows: dict[int, list[QRectF]] = {}
+        for y in range(height):
+            start = y * total // height
+            end = max((y + 1) * total // height, start + 1)
+            length, color = overview.sample(
+                start, min(end, history_length), screen.history_summary
+            )
+            for summary in screen_lines[
+                max(start - history_length, 0) : end - history_length
+            ]:
+                if summary[0] > length:
+                    length = summary[0]
+                color = max(color, overview.color_index(summary[1]))
+
+            if length > 0:
+                rect = QRectF(0, y, width * min(length / self.columns, 1), 1)
+                rows.setdefault(color, []).append(rect)
+
+        painter = QPainter(self.minimap)
+        for index, rects in rows.items():
+            fg = overview.palette[index]
+            color = QColor(self.get_color("white" if fg == "default" else fg))
+            color.setAlpha(160)
+            for rect in rects:
+                painter.fillRect(rect, color)
+
+        dropped = screen.history_dropped
+        marks = [
+            (self.color_map["yellow"], screen.prompt_marks["A"]),
+            (self.color_map["red"], sorted(screen.trigger_lines)),
+        ]
+        for color, lines in marks:
+            color = QColor(color)
+            for line_num in lines:
+                line_num -= dropped
+                if 0 <= line_num < total:
+                    y = line_num * height // total
+                    painter.fillRect(QRectF(0, y, width, 2), color)
+
+    def minimap_rect(self) -> QRectF:
+        return QRectF(
+            self.width() - self.minimap_width, 0, self.minimap_width, self.height()
+        )
+
+    def paint_minimap(self, painter: QPainter):
+        if self.minimap is None or not self.has_minimap():
+            return
+
+        rect = self.minimap_rect()
+        painter.drawPixmap(rect.topLeft(), self.minimap)
+
+        # The lines on the screen
+        screen = self.backend.screen
+        base = screen.base if screen.in_history else len(screen.history.top)
+        total = self.minimap_lines()
+        view = QRectF(
+            rect.left(),
+            base * self.height() / total,
+            self.minimap_width,
+            max(self.rows * self.height() / total, 2),
+        )
+        color = QColor(self.color_map["white"])
+        color.setAlpha(60)
+        painter.fillRect(view, color)
+
+    def jump_minimap(self, y: float):
+        """Center the screen on the line at y of the minimap."""
+        screen = self.backend.screen
+        line_num = int(y * self.minimap_lines() / self.height())
+        base = line_num - self.rows // 2
+        screen.scroll_to(min(max(base, 0), len(screen.history.top)))
+        self.update(self.minimap_rect().toAlignedRect())
 
     def paintEvent(self, _):
         painter = QPainter(self)
         painter.drawPixmap(0, 0, self.pixmap)
+        self.paint_minimap(painter)
+
+        self.paint_selection(painter)
+        self.paint_cursor(painter)
+        self.paint_link_markers(painter)
+
+        if self.flood_mode:
+            self.paint_flood_indicator(painter)
+
+    def update_flood_mode(self):
+        """Enter flood mode when the output rate stays above the threshold
+        for a sample, leave it when the rate drops below half of it."""
+        now = time.time()
+        elapsed = now - self.flood_sample_time
+        if elapsed < FLOOD_SAMPLE_SECONDS:
+            return
+
+        read_bytes = self.backend.read_bytes
+        rate = (read_bytes - self.flood_sample_bytes) / elapsed
+        self.flood_sample_time = now
+        self.flood_sample_bytes = read_bytes
+
+        if not self.flood_mode and rate > self.flood_threshold:
+            self.flood_mode = True
+        elif self.flood_mode and rate < self.flood_threshold / 2:
+            self.flood_mode = False
+            self.update()
 
     @PostGui()
     def timerEvent(self, _):
+        notifier = self.backend.notifier
+        notifier.flush()
+
+        self.update_flood_mode()
+
+        now = time.time()
+        if self.auto_scroll_speed:
+            self.step_auto_scroll(now)
+
+        if self.isVisible():
+            scrollback.viewed(self.backend)
+        scrollback.enforce(now)
+
+        self.update_minimap(now)
+
+        # Only show the latest screen at a reduced frame rate, intermediate
+        # frames are still parsed into the screen and the history.
+        if (
+            self.flood_mode
+            and now - self.last_paint_time < self.flood_refresh_ms / 1000
+        ):
+            return
+
         screen = self.backend.screen
+        screen.resolve_selection()
+        selection = screen.selection_spans()
+
         cursor = screen.get_cursor()
+        cursor_moved = (
+            self.cursor.x != cursor.x
+            or self.cursor.y != cursor.y
+            or self.cursor.hidden != cursor.hidden
+        )
+
+        blink = False
+        if cursor_moved:
+            self.cursor_blink_on = True
+            self.last_blink_time = now
+        elif (
+            self.cursor_blink_ms > 0
+            and now - self.last_blink_time >= self.cursor_blink_ms / 1000
+        ):
+            self.cursor_blink_on = not self.cursor_blink_on
+            self.last_blink_time = now
+            blink = True
 
         if (
             not screen.dirty
             and not screen.cursor_dirty
-            and self.cursor.x == cursor.x
-            and self.cursor.y == cursor.y
-            and self.cursor.hidden == cursor.hidden
+            and not cursor_moved
+            and not blink
+            and self.marker == screen.marker
+            and self.selection == selection
         ):
             return
 
-        if (
-            screen.cursor_dirty
-            and self.cursor.x == cursor.x
-            and self.cursor.y == cursor.y
-        ):
-            painter = QPainter(self.pixmap)
-            screen.cursor_dirty = False
-            self.paint_cursor(painter)
-            self.update()
-        else:
+        old_cursor_rect = self.cursor_rect()
+        self.cursor.x = cursor.x
+        self.cursor.y = cursor.y
+        self.cursor.hidden = cursor.hidden
+
+        if screen.dirty:
+            # Lines only trigger once complete, but prompts wait on the line
+            # of the cursor
+            if screen.triggers:
+                # The reading thread checks and records firings too
+                with self.backend.feed_lock:
+                    screen.check_triggers(screen.cursor.y)
             self.paint_pixmap()
             self.update()
-
-        title = self.backend.title()
-        if title != self.title:
-            self.title = title
-            self.change_title(f"Term [{title}]")
-
+        elif screen.cursor_dirty:
+            self.update()
+        else:
+            # The text pixmap is composited again under the old and new
+            # cursor and the lines whose selection changed
+            self.update(old_cursor_rect.toAlignedRect())
+            self.update(self.cursor_rect().toAlignedRect())
+
+            for y in selection.keys() | self.selection.keys():
+                if selection.get(y) != self.selection.get(y):
+                    row_y = (y - screen.base) * self.char_height
+                    rect = QRectF(0, row_y, self.width(), self.char_height)
+                    self.update(rect.toAlignedRect())
+
+        screen.cursor_dirty = False
+        self.marker = screen.marker
+        self.selection = selection
+        self.last_paint_time = now
+
+        # Reading the directory updates the foreground job, which names
+        # terminals without a title
         directory = self.backend.getcwd()
-        if directory and directory != self.directory:
-            self.directory = directory
-            eval_in_emacs("eaf--change-default-directory", [self.buffer_id, directory])
+        title = self.backend.title() or self.backend.foreground_name()
+        notifier.post("title", self.change_title, f"Term [{title}]")
+
+        if directory:
+            notifier.post(
+                "directory",
+                eval_in_emacs,
+                "eaf--change-default-directory",
+                [self.buffer_id, directory],
+            )
 
     def keyPressEvent(self, event: QKeyEvent):
         text = str(event.text())
@@ -595,20 +1087,77 @@ class FrontendWidget(QWidget):
         self.update()
 
     def auto_scroll(self, y):
-        screen = self.backend.screen
-        if y < 0 and screen.auto_scroll_lock:
-            screen.auto_scroll_up()
-        elif y > self.height() and screen.auto_scroll_lock:
-            screen.auto_scroll_down()
-        elif 0 < y < self.height() and screen.current_thread:
-            screen.disable_auto_scroll()
+        """Set the speed of scrolling by how far the pointer is outside."""
+        if y < 0:
+            distance = y / self.char_height - 1
+        elif y > self.height():
+            distance = (y - self.height()) / self.char_height + 1
+        else:
+            distance = 0
+
+        if distance and not self.auto_scroll_speed:
+            self.last_auto_scroll_time = time.time()
+            self.auto_scroll_lines = 0.0
+        self.auto_scroll_speed = distance * AUTO_SCROLL_SPEED
+
+    def step_auto_scroll(self, now: float):
+        """Scroll the lines due since the last frame."""
+        self.auto_scroll_lines += self.auto_scroll_speed * (
+            now - self.last_auto_scroll_time
+        )
+        self.last_auto_scroll_time = now
+
+        line_num = int(self.auto_scroll_lines)
+        if line_num:
+            self.auto_scroll_lines -= line_num
+            self.backend.screen.auto_scroll(line_num)
+
+    def minimap_event(self, event: QEvent) -> bool:
+        """Jump to the lines under the pointer while it's pressed on the
+        minimap."""
+        event_type = event.type()
+        x, y = self.get_cursor_absolute_position()
+
+        if event_type == QEvent.Type.MouseButtonPress:
+            if x < self.width() - self.minimap_width:
+                return False
+            self.minimap_dragging = True
+            self.grabMouse()
+        elif not self.minimap_dragging:
+            return False
+        elif event_type == QEvent.Type.MouseButtonRelease:
+            self.minimap_dragging = False
+            self.releaseMouse()
+            return True
+
+        self.jump_minimap(min(max(y, 0), self.height() - 1))
+        return True
 
     def eventFilter(self, _, event: QEvent):
         screen = self.backend.screen
 
+        if (
+            event.type()
+            in (
+                QEvent.Type.MouseButtonPress,
+                QEvent.Type.MouseMove,
+                QEvent.Type.MouseButtonRelease,
+            )
+            and self.has_minimap()
+            and self.minimap_event(event)
+        ):
+            return True
+
         if event.type() == QEvent.Type.MouseButtonPress:
             x, y = self.get_cursor_absolute_position()
             column, row = self.pixel_to_position(x, y)
+
+            if event.modifiers() & Qt.KeyboardModifier.ControlModifier:
+                link = get_link(screen.get_line(row), column)
+                if link:
+                    open_url_in_new_tab(link)
+                    return True
+
             screen.move_to_position(column, row)
             self.last_mouse_click_time = time.time()
             self.last_mouse_click_position = (x, y)
@@ -627,8 +1176,10 @@ class FrontendWidget(QWidget):
             column, row = self.pixel_to_position(x, y)
             if y < 0:
                 row = -1
-                screen.move_to_position(column, row)
-                screen.absolute_virtual_cursor_y = screen.base + row
+            screen.move_to_position(column, row)
+            screen.absolute_virtual_cursor_y = screen.base + min(
+                row, screen.virtual_cursor.y
+            )
 
             if self.first_mouse_move:
                 self.first_mouse_move = False
@@ -643,8 +1194,7 @@ class FrontendWidget(QWidget):
         elif event.type() == QEvent.Type.MouseButtonRelease:
             self.first_mouse_move = True
 
-            if screen.current_thread:
-                screen.disable_auto_scroll()
+            self.auto_scroll_speed = 0.0
 
             x, y = self.get_cursor_absolute_position()
 
@@ -653,7 +1203,7 @@ class FrontendWidget(QWidget):
                 screen.cursor_move_mode = False
                 screen.sync_cursor()
 
-                eval_in_emacs("eaf--toggle-cursor-move-mode", ["'nil"])
+                screen.notify_cursor_move_mode(False)
 
             self.releaseMouse()
 
@@ -662,7 +1212,27 @@ class FrontendWidget(QWidget):
     @interactive
     def yank_text(self):
         text = get_clipboard_text()
-        self.backend.send(text)
+        self.backend.paste(text)
+
+    @interactive
+    def detach_terminal(self):
+        if not self.backend.is_hosted():
+            message_to_emacs(
+                "The terminal doesn't run in the host, "
+                "set eaf-pyqterminal-use-host to detach terminals"
+            )
+            return
+
+        self.backend.detach()
+        self.backend.close_buffer()
+
+    @interactive
+    def show_scrollback_usage(self):
+        message_to_emacs(scrollback.summary(self.backend))
+
+    @interactive
+    def show_input_latency(self):
+        message_to_emacs(self.backend.pty.latency.summary())
 
     @interactive
     def scroll_up(self):
@@ -750,6 +1320,91 @@ class FrontendWidget(QWidget):
     def copy_symbol(self):
         self.backend.screen.copy_thing("symbol")
 
+    @interactive
+    def toggle_recording(self):
+        if self.backend.recorder:
+            path = self.backend.recorder.path
+            self.backend.stop_recording()
+            message_to_emacs(f"Recording saved to {path}")
+        else:
+            self.send_input_message("Record to: ", "start_recording", "file")
+
+    @interactive
+    def replay_recording(self):
+        self.send_input_message("Replay recording: ", "replay_recording", "file")
+
+    @interactive
+    def replay_recording_fast(self):
+        self.send_input_message(
+            "Replay recording as fast as possible: ", "replay_recording_fast", "file"
+        )
+
+    @interactive
+    def export_selection(self):
+        self.send_input_message(
+            "Export selection to (file or *buffer*): ", "export_selection", "file"
+        )
+
+    @interactive
+    def export_history(self):
+        self.send_input_message(
+            "Export history to (file or *buffer*): ", "export_history", "file"
+        )
+
+    @interactive
+    def export_last_output(self):
+        self.send_input_message(
+            "Export last output to (file or *buffer*): ", "export_last_output", "file"
+        )
+
+    def goto_prompt(self, reverse: bool):
+        screen = self.backend.screen
+        if not screen.cursor_move_mode:
+            self.toggle_cursor_move_mode(True)
+
+        line_num = screen.find_prompt(
+            screen.absolute_y(screen.virtual_cursor.y), reverse
+        )
+        if line_num is None:
+            message_to_emacs("No previous prompt" if reverse else "No next prompt")
+            return
+
+        screen.goto_line(line_num)
+
+    @interactive
+    def previous_prompt(self):
+        self.goto_prompt(True)
+
+    @interactive
+    def next_prompt(self):
+        self.goto_prompt(False)
+
+    @interactive
+    def select_last_output(self):
+        screen = self.backend.screen
+        selection = screen.get_last_output_range()
+        if selection is None:
+            message_to_emacs("No command output")
+            return
+
+        if not screen.cursor_move_mode:
+            self.toggle_cursor_move_mode(True)
+
+        start, end = selection
+        screen.goto_line(end[1])
+        screen.move_end_of_line()
+        screen.marker = start
+
+    @interactive
+    def copy_last_output(self):
+        screen = self.backend.screen
+        selection = screen.get_last_output_range()
+        if selection is None:
+            message_to_emacs("No command output")
+            return
+
+        screen._copy(*selection)
+
     @interactive
     def open_link(self):
         self.get_link_markers()
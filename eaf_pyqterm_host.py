@@ -0,0 +1,516 @@
+# Copyright (C) 2023 by Mumulhl <mumulhl@duck.com>
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+"""Host process owning the ptys of terminals, so they keep running when
+EAF exits and can be attached again.
+
+Run as ``python eaf_pyqterm_host.py SOCKET``, ``connect`` starts it when
+needed. It runs outside of EAF, with the screen of eaf_pyqterm_term but
+without Qt.
+
+Messages are a type byte and a u32 length followed by the payload:
+
+- Client to host: ``OPEN`` (JSON of the key, argv, directory and size),
+  ``INPUT``, ``RESIZE`` (u16 columns and lines) and ``KILL``.
+- Host to client: ``PID`` (i32 pid and u8 attached), ``OUTPUT`` and
+  ``EXIT``.
+
+A client opening a key which has a detached terminal is attached to it.
+The host parses the output into screens, so the client gets their state
+and the last lines of history instead of output starting in the middle
+of a sequence. Closing the connection without ``KILL`` detaches it.
+
+The client still parses the output it gets to draw it, so the output of
+a hosted terminal is parsed twice, and costs about twice the CPU of a
+local one. Neither parsing runs on the GUI thread of EAF.
+
+The socket is in a directory only the user can access, and both ends
+check that the other one runs as the same user.
+"""
+
+import json
+import os
+import re
+import selectors
+import signal
+import socket
+import stat
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+from pyte import modes as mo
+
+from eaf_pyqterm_export import DEFAULT_STYLE, sgr
+from eaf_pyqterm_term import TerminalScreen, TerminalStream
+
+if sys.platform != "win32":
+    import fcntl
+    import pty
+    import termios
+
+MESSAGE_HEADER = struct.Struct("<BI")
+PID = struct.Struct("<iB")
+SIZE = struct.Struct("<HH")
+# struct ucred of SO_PEERCRED
+PEER_CREDENTIALS = struct.Struct("iII")
+
+OPEN, INPUT, RESIZE, KILL = b"OIRK"
+PID_MESSAGE, OUTPUT, EXIT = b"PDX"
+
+# Lines of history kept to rebuild the scrollback of an attaching client
+HISTORY_LINES = 1000
+# Output queued for a client which doesn't read, it's detached beyond that
+MAX_QUEUED = 16 << 20
+CONNECT_TIMEOUT = 3
+
+ENTER_BUFFER_SCREEN = "\x1b[?1049h"
+SWITCH_LENGTH = len(ENTER_BUFFER_SCREEN)
+SCREEN_SWITCH = re.compile(rb"\x1b\[\?1049([hl])")
+SCREEN_SWITCH_MODE = 1049 << 5
+DEFAULT_MODES = {mo.DECAWM, mo.DECTCEM}
+
+
+def socket_path() -> str:
+    """Path of the socket, in a directory private to the user so another
+    user can't put a socket in its place."""
+    base = os.environ.get("XDG_RUNTIME_DIR") or tempfile.gettempdir()
+    directory = os.path.join(base, f"eaf-pyqterminal-{os.getuid()}")
+    try:
+        os.mkdir(directory, 0o700)
+    except FileExistsError:
+        pass
+
+    info = os.lstat(directory)
+    if (
+        not stat.S_ISDIR(info.st_mode)
+        or info.st_uid != os.getuid()
+        or info.st_mode & 0o077
+    ):
+        raise PermissionError(f"{directory} isn't private to the user")
+    return os.path.join(directory, "host.sock")
+
+
+def check_peer(sock: socket.socket) -> None:
+    """Raise PermissionError if the other end of ``sock`` runs as another
+    user, systems without SO_PEERCRED rely on the private directory."""
+    if not hasattr(socket, "SO_PEERCRED"):
+        return
+
+    credentials = sock.getsockopt(
+        socket.SOL_SOCKET, socket.SO_PEERCRED, PEER_CREDENTIALS.size
+    )
+    _, uid, _ = PEER_CREDENTIALS.unpack(credentials)
+    if uid != os.getuid():
+        raise PermissionError(f"Peer of the host socket runs as user {uid}")
+
+
+def pack(message_type: int, payload: bytes = b"") -> bytes:
+    return MESSAGE_HEADER.pack(message_type, len(payload)) + payload
+
+
+def unpack(buffer: bytearray) -> tuple[int, bytes] | None:
+    """Pop a message from ``buffer``, None if it isn't complete."""
+    if len(buffer) < MESSAGE_HEADER.size:
+        return None
+
+    message_type, length = MESSAGE_HEADER.unpack_from(buffer)
+    end = MESSAGE_HEADER.size + length
+    if len(buffer) < end:
+        return None
+
+    payload = bytes(buffer[MESSAGE_HEADER.size : end])
+    del buffer[:end]
+    return message_type, payload
+
+
+def connect(path: str) -> socket.socket:
+    """Connect to the host at ``path``, start it if it isn't running."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError:
+        start_host(sock, path)
+
+    try:
+        check_peer(sock)
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
+def start_host(sock: socket.socket, path: str) -> None:
+    """Start the host and connect ``sock`` to it."""
+    subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), path],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        start_new_session=True,
+    )
+
+    deadline = time.monotonic() + CONNECT_TIMEOUT
+    while True:
+        try:
+            sock.connect(path)
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                sock.close()
+                raise
+            time.sleep(0.02)
+
+
+def render_line(line, columns: int) -> str:
+    """Output drawing ``line``, unlike an ANSI export the blanks with a
+    background are kept."""
+    end = columns
+    while end and line[end - 1].data == " " and line[end - 1][1:] == DEFAULT_STYLE:
+        end -= 1
+
+    parts = []
+    style = DEFAULT_STYLE
+    for x in range(end):
+        char = line[x]
+        if char[1:] != style:
+            parts.append(sgr(char))
+            style = char[1:]
+        parts.append(char.data)
+    if style != DEFAULT_STYLE:
+        parts.append("\x1b[0m")
+    return "".join(parts)
+
+
+def render_screen(screen: TerminalScreen, history: bool) -> str:
+    """Output drawing the state of ``screen`` on a new screen of the same
+    size, the lines of its history scroll into the history first."""
+    columns = screen.columns
+    lines = list(screen.history.top) if history else []
+    lines += [screen.buffer[y] for y in range(screen.lines)]
+
+    # Lines are drawn with the default modes, e.g. before insert mode
+    parts = ["\r\n".join(render_line(line, columns) for line in lines)]
+    parts.append("\x1b[0m")
+
+    for mode in screen.mode | DEFAULT_MODES:
+        # The columns are already those of the client, and the screen is
+        # switched separately
+        if mode in (mo.DECCOLM, SCREEN_SWITCH_MODE):
+            continue
+        private = "?" if mode >= 1 << 5 else ""
+        number = mode >> 5 if private else mode
+        action = "h" if mode in screen.mode else "l"
+        parts.append(f"\x1b[{private}{number}{action}")
+
+    if screen.margins:
+        top, bottom = screen.margins
+        parts.append(f"\x1b[{top + 1};{bottom + 1}r")
+
+    cursor = screen.cursor
+    y = cursor.y
+    if mo.DECOM in screen.mode and screen.margins:
+        y -= screen.margins.top
+    if cursor.x < columns:
+        parts.append(f"\x1b[{y + 1};{cursor.x + 1}H")
+    else:
+        # Draw the last character again to wrap at the next one
+        last = screen.buffer[cursor.y][columns - 1]
+        parts.append(f"\x1b[{y + 1};{columns}H{sgr(last)}{last.data or ' '}")
+    parts.append(sgr(cursor.attrs))
+
+    if screen.title:
+        parts.append(f"\x1b]2;{screen.title}\x07")
+    return "".join(parts)
+
+
+class ScreenState:
+    """The screens of a terminal, parsed from its output like the client
+    does."""
+
+    def __init__(self, columns: int, lines: int):
+        self.screen = TerminalScreen(False, columns, lines, HISTORY_LINES)
+        # The history of the buffer screen isn't shown
+        self.buffer_screen = TerminalScreen(True, columns, lines, 1)
+        self.stream = TerminalStream(self.screen)
+        self.buffer_stream = TerminalStream(self.buffer_screen)
+        self.in_buffer_screen = False
+        # The start of a switch of screens at the end of the last data
+        self.pending = b""
+
+    def resize(self, columns: int, lines: int) -> None:
+        self.screen.resize(lines, columns)
+        self.buffer_screen.resize(lines, columns)
+
+    def feed(self, data: bytes) -> None:
+        data = self.pending + data
+        start = data.rfind(b"\x1b", -SWITCH_LENGTH + 1)
+        if start != -1 and ENTER_BUFFER_SCREEN.encode()[:-1].startswith(data[start:]):
+            self.pending = data[start:]
+            data = data[:start]
+        else:
+            self.pending = b""
+
+        parts = SCREEN_SWITCH.split(data)
+        for index, part in enumerate(parts):
+            if index % 2 == 0:
+                stream = self.buffer_stream if self.in_buffer_screen else self.stream
+                try:
+                    stream.feed(part)
+                except Exception:
+                    # Like the client, which avoids problems with vim
+                    pass
+            elif part == b"h":
+                self.in_buffer_screen = True
+            elif self.in_buffer_screen:
+                self.in_buffer_screen = False
+                self.buffer_screen.reset()
+
+    def snapshot(self) -> bytes:
+        parts = [render_screen(self.screen, True)]
+        if self.in_buffer_screen:
+            parts.append(ENTER_BUFFER_SCREEN)
+            parts.append(render_screen(self.buffer_screen, False))
+        return "".join(parts).encode()
+
+
+class Terminal:
+    def __init__(
+        self,
+        key: str,
+        argv: list[str],
+        directory: str,
+        env: dict,
+        columns: int,
+        lines: int,
+    ):
+        self.key = key
+        self.client = None
+        self.state = ScreenState(columns, lines)
+        self.input = bytearray()
+
+        self.pid, self.fd = pty.fork()
+        if self.pid == 0:
+            os.chdir(directory)
+            os.execvpe(argv[0], argv, {**os.environ, **env})
+
+        os.set_blocking(self.fd, False)
+
+    def resize(self, columns: int, lines: int) -> None:
+        self.state.resize(columns, lines)
+        size = struct.pack("HHHH", lines, columns, 0, 0)
+        try:
+            fcntl.ioctl(self.fd, termios.TIOCSWINSZ, size)
+        except OSError:
+            pass
+
+
+class Connection:
+    def __init__(self, sock: socket.socket):
+        self.sock = sock
+        self.sock.setblocking(False)
+        self.received = bytearray()
+        self.queued = bytearray()
+        self.terminal = None
+
+
+class Host:
+    def __init__(self, path: str):
+        self.selector = selectors.DefaultSelector()
+        self.terminals: dict[int, Terminal] = {}
+        self.connections: dict[int, Connection] = {}
+        self.started = False
+
+        # Another host may be starting, only remove a dead socket
+        try:
+            socket.socket(socket.AF_UNIX).connect(path)
+            sys.exit(0)
+        except OSError:
+            if os.path.exists(path):
+                os.unlink(path)
+
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(path)
+        os.chmod(path, 0o600)
+        self.server.listen()
+        self.selector.register(self.server, selectors.EVENT_READ)
+        self.path = path
+
+    def run(self) -> None:
+        while self.terminals or self.connections or not self.started:
+            for key, events in self.selector.select():
+                if key.fileobj is self.server:
+                    self.accept()
+                elif key.fd in self.terminals:
+                    self.handle_terminal(self.terminals[key.fd], events)
+                elif key.fd in self.connections:
+                    self.handle_connection(self.connections[key.fd], events)
+
+        os.unlink(self.path)
+
+    def accept(self) -> None:
+        sock, _ = self.server.accept()
+        try:
+            check_peer(sock)
+        except OSError:
+            sock.close()
+            return
+
+        connection = Connection(sock)
+        self.connections[sock.fileno()] = connection
+        self.selector.register(sock, selectors.EVENT_READ)
+        self.started = True
+
+    def update_events(self, fileobj, writing: bool) -> None:
+        events = selectors.EVENT_READ
+        if writing:
+            events |= selectors.EVENT_WRITE
+        self.selector.modify(fileobj, events)
+
+    def send(self, connection: Connection, message: bytes) -> None:
+        if len(connection.queued) > MAX_QUEUED:
+            self.detach(connection)
+            return
+
+        writing = bool(connection.queued)
+        connection.queued += message
+        if not writing:
+            self.update_events(connection.sock, True)
+
+    def handle_terminal(self, terminal: Terminal, events: int) -> None:
+        if events & selectors.EVENT_WRITE:
+            try:
+                written = os.write(terminal.fd, terminal.input)
+            except BlockingIOError:
+                written = 0
+            except OSError:
+                written = len(terminal.input)
+            del terminal.input[:written]
+            if not terminal.input:
+                self.update_events(terminal.fd, False)
+
+        if events & selectors.EVENT_READ:
+            try:
+                data = os.read(terminal.fd, 65536)
+            except BlockingIOError:
+                return
+            except OSError:
+                data = b""
+
+            if not data:
+                self.exit(terminal)
+                return
+
+            if terminal.client:
+                self.send(terminal.client, pack(OUTPUT, data))
+            terminal.state.feed(data)
+
+    def exit(self, terminal: Terminal) -> None:
+        self.selector.unregister(terminal.fd)
+        del self.terminals[terminal.fd]
+        os.close(terminal.fd)
+
+        # Sending may detach the client
+        client = terminal.client
+        if client:
+            client.terminal = None
+            self.send(client, pack(EXIT))
+
+    def handle_connection(self, connection: Connection, events: int) -> None:
+        if events & selectors.EVENT_WRITE:
+            try:
+                sent = connection.sock.send(connection.queued)
+            except BlockingIOError:
+                sent = 0
+            except OSError:
+                self.detach(connection)
+                return
+            del connection.queued[:sent]
+            if not connection.queued:
+                self.update_events(connection.sock, False)
+
+        if events & selectors.EVENT_READ:
+            try:
+                data = connection.sock.recv(65536)
+            except BlockingIOError:
+                return
+            except OSError:
+                data = b""
+
+            if not data:
+                self.detach(connection)
+                return
+
+            connection.received += data
+            while connection.sock.fileno() in self.connections:
+                message = unpack(connection.received)
+                if message is None:
+                    break
+                self.handle_message(connection, *message)
+
+    def handle_message(self, connection: Connection, message_type, payload) -> None:
+        terminal = connection.terminal
+
+        if message_type == OPEN:
+            self.open(connection, json.loads(payload))
+        elif terminal is None:
+            return
+        elif message_type == INPUT:
+            if not terminal.input:
+                self.update_events(terminal.fd, True)
+            terminal.input += payload
+        elif message_type == RESIZE:
+            terminal.resize(*SIZE.unpack(payload))
+        elif message_type == KILL:
+            try:
+                os.kill(terminal.pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    def open(self, connection: Connection, request: dict) -> None:
+        key = request["key"]
+        for terminal in self.terminals.values():
+            if terminal.key == key and terminal.client is None:
+                attached = True
+                break
+        else:
+            attached = False
+            terminal = Terminal(
+                key,
+                request["argv"],
+                request["directory"],
+                request["env"],
+                request["columns"],
+                request["lines"],
+            )
+            self.terminals[terminal.fd] = terminal
+            self.selector.register(terminal.fd, selectors.EVENT_READ)
+
+        terminal.client = connection
+        connection.terminal = terminal
+        terminal.resize(request["columns"], request["lines"])
+
+        self.send(connection, pack(PID_MESSAGE, PID.pack(terminal.pid, attached)))
+        if attached:
+            self.send(connection, pack(OUTPUT, terminal.state.snapshot()))
+
+    def detach(self, connection: Connection) -> None:
+        if connection.terminal:
+            connection.terminal.client = None
+
+        self.selector.unregister(connection.sock)
+        del self.connections[connection.sock.fileno()]
+        connection.sock.close()
+
+
+def main() -> None:
+    # Exited children are reaped by the kernel
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    Host(sys.argv[1]).run()
+
+
+if __name__ == "__main__":
+    main()
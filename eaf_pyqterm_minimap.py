@@ -0,0 +1,106 @@
+# Copyright (C) 2023 by Mumulhl <mumulhl@duck.com>
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+"""Overview of the scrollback of a terminal, drawn as a minimap.
+
+Every line entering the history is summarized as the end of its text and
+a color in it, shared history lines keep their summary. Restored
+lines are only summarized once the minimap samples them, so they are not
+decoded all at once. The minimap downsamples the summaries to a row per
+pixel with a slice of the arrays, so drawing it doesn't grow with the
+length of the history in Python code.
+"""
+
+from array import array
+from operator import itemgetter
+
+# Lengths are stored plus one, 0 is a line which isn't summarized yet
+UNKNOWN = 0
+MAX_LENGTH = 0xFFFE
+MAX_COLORS = 256
+# Dropped summaries are only removed past this count
+COMPACT_LINES = 4096
+
+FOREGROUND = itemgetter(1)
+
+
+def line_summary(line) -> tuple[int, str]:
+    """End of the text of a line, like ``get_end_x``, and one of its
+    foreground colors."""
+    length = max(line, default=-1) + 1
+    while length and line[length - 1].data == " ":
+        length -= 1
+
+    colors = set(map(FOREGROUND, line.values()))
+    colors.discard("default")
+    return length, min(colors) if colors else "default"
+
+
+class Overview:
+    def __init__(self):
+        self.lengths = array("H")
+        self.colors = array("B")
+        # Colors by index, 0 is the default one
+        self.palette = ["default"]
+        self.palette_indexes = {"default": 0}
+        # Summaries before start belong to dropped lines
+        self.start = 0
+        # Changed with every summary, so the minimap is only drawn again
+        # when the history changed
+        self.version = 0
+
+    def __len__(self) -> int:
+        return len(self.lengths) - self.start
+
+    def color_index(self, color: str) -> int:
+        index = self.palette_indexes.get(color)
+        if index is None:
+            # Colors beyond the palette are drawn as the default one
+            if len(self.palette) == MAX_COLORS:
+                return 0
+            index = self.palette_indexes[color] = len(self.palette)
+            self.palette.append(color)
+        return index
+
+    def append(self, summary: tuple[int, str]) -> None:
+        length, color = summary
+        self.lengths.append(min(length, MAX_LENGTH) + 1)
+        self.colors.append(self.color_index(color))
+        self.version += 1
+
+    def extend_unknown(self, count: int) -> None:
+        self.lengths.extend(array("H", bytes(2 * count)))
+        self.colors.extend(bytes(count))
+        self.version += 1
+
+    def drop(self, count: int) -> None:
+        self.start = min(self.start + count, len(self.lengths))
+        if self.start >= COMPACT_LINES and self.start * 2 >= len(self.lengths):
+            del self.lengths[: self.start]
+            del self.colors[: self.start]
+            self.start = 0
+        self.version += 1
+
+    def clear(self) -> None:
+        self.lengths = array("H")
+        self.colors = array("B")
+        self.start = 0
+        self.version += 1
+
+    def sample(self, start: int, end: int, summarize) -> tuple[int, int]:
+        """Longest length and a color of the lines from ``start`` to
+        ``end``, -1 if there are none. The first unknown line is
+        summarized with ``summarize`` on every call."""
+        begin = self.start + start
+        lengths = self.lengths[begin : self.start + end]
+        if not lengths:
+            return -1, 0
+
+        if UNKNOWN in lengths:
+            index = lengths.index(UNKNOWN)
+            length, color = summarize(start + index)
+            length = min(length, MAX_LENGTH) + 1
+            self.lengths[begin + index] = lengths[index] = length
+            self.colors[begin + index] = self.color_index(color)
+
+        return max(lengths) - 1, max(self.colors[begin : self.start + end])
@@ -0,0 +1,67 @@
+# Copyright (C) 2023 by Mumulhl <mumulhl@duck.com>
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+"""Recording of the raw output of a terminal.
+
+A recording is ``MAGIC`` followed by records of the seconds since the
+start of the recording (f64), the data length (u32) and the data.
+"""
+
+import struct
+import time
+from typing import Callable, Iterator
+
+MAGIC = b"EAFPQTR1"
+RECORD_HEADER = struct.Struct("<dI")
+
+
+class Recorder:
+    def __init__(self, path: str):
+        self.path = path
+        self.file = open(path, "wb")
+        self.file.write(MAGIC)
+        self.start = time.monotonic()
+
+    def write(self, data: bytes) -> None:
+        header = RECORD_HEADER.pack(time.monotonic() - self.start, len(data))
+        self.file.write(header)
+        self.file.write(data)
+
+    def close(self) -> None:
+        self.file.close()
+
+
+def read_records(path: str) -> Iterator[tuple[float, bytes]]:
+    """Records of a recording, read one at a time so a big recording isn't
+    loaded in memory."""
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a recording")
+
+        while True:
+            header = f.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return
+            timestamp, length = RECORD_HEADER.unpack(header)
+            yield timestamp, f.read(length)
+
+
+def replay(
+    path: str, write: Callable[[bytes], None], realtime: bool = True
+) -> tuple[int, float]:
+    """Feed a recording to ``write``, return the bytes and seconds it takes.
+
+    If ``realtime`` is false, replay as fast as possible."""
+    size = 0
+    start = time.monotonic()
+
+    for timestamp, data in read_records(path):
+        if realtime:
+            delay = timestamp - (time.monotonic() - start)
+            if delay > 0:
+                time.sleep(delay)
+
+        write(data)
+        size += len(data)
+
+    return size, time.monotonic() - start
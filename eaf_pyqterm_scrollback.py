@@ -0,0 +1,210 @@
+# Copyright (C) 2023 by Mumulhl <mumulhl@duck.com>
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+"""Memory budget of the scrollback of all terminals.
+
+Every screen keeps an estimate of the memory of its history. Once the
+total is over the budget, the oldest lines of the terminals viewed least
+recently are compressed first, then dropped.
+"""
+
+import sys
+import time
+
+from pyte.screens import Char
+
+from eaf_pyqterm_session import decode_runs, iter_runs, loaded_lines
+
+# Estimated memory of the attributes of a history line and of each of
+# its characters, which are often shared
+LINE_BYTES = 300
+CELL_BYTES = 40
+# Estimated memory of a compressed line and of each of its runs
+COMPRESSED_LINE_BYTES = 150
+RUN_BYTES = 250
+
+# Estimated memory of another use of a shared history line
+SHARED_LINE_BYTES = 8
+
+ENFORCE_INTERVAL = 1
+
+
+def line_bytes(line) -> int:
+    size = getattr(line, "size", None)
+    if size is None:
+        size = LINE_BYTES + sys.getsizeof(line) + CELL_BYTES * len(line)
+    return size
+
+
+def format_bytes(size: int) -> str:
+    return f"{size / (1 << 20):.1f}MiB"
+
+
+class CompressedLine(dict):
+    """A history line stored as runs of the same style, which is decoded
+    on use."""
+
+    __slots__ = ("runs", "default", "links", "wide", "size", "loaded")
+
+    def __init__(self, line):
+        self.runs = iter_runs(line)
+        self.default = line.default
+        self.links = line.links
+        self.wide = line.wide
+        # Only a bounded number of lines are decoded at once, see
+        # LoadedLines, so the size is that of the runs
+        self.size = COMPRESSED_LINE_BYTES + sum(
+            RUN_BYTES + len(text) for _, text in self.runs
+        )
+        self.loaded = False
+
+    def load(self) -> None:
+        if not self.loaded:
+            self.loaded = True
+            self.update(decode_runs(self.runs))
+            loaded_lines.add(self)
+
+    def unload(self) -> None:
+        # Marked first, so a line read meanwhile is loaded again
+        self.loaded = False
+        self.clear()
+
+    def __missing__(self, key: int) -> Char:
+        if not self.loaded:
+            self.load()
+            if key in self:
+                return self[key]
+        return self.default
+
+    def __len__(self) -> int:
+        self.load()
+        return super().__len__()
+
+    def __iter__(self):
+        self.load()
+        return super().__iter__()
+
+    def items(self):
+        self.load()
+        return super().items()
+
+    def values(self):
+        self.load()
+        return super().values()
+
+
+class LineTable:
+    """Hash-consing of the history lines of a screen.
+
+    Identical lines are stored once, with the count of their uses in the
+    history, so the memory of a line is released with its last use."""
+
+    def __init__(self):
+        self.lines: dict = {}
+        self.hits = 0
+        self.misses = 0
+
+    def intern(self, line) -> tuple:
+        """Return the shared line equal to ``line`` and the bytes it adds
+        to the history."""
+        entry = self.lines.get(line)
+        if entry:
+            entry[1] += 1
+            self.hits += 1
+            return entry[0], SHARED_LINE_BYTES
+
+        self.lines[line] = [line, 1]
+        self.misses += 1
+        return line, line_bytes(line)
+
+    def uses(self, line) -> int:
+        entry = self.lines.get(line)
+        return entry[1] if entry else 0
+
+    def release(self, line) -> int:
+        """Remove a use of ``line``, return the bytes it frees."""
+        entry = self.lines[line]
+        entry[1] -= 1
+        if entry[1]:
+            return SHARED_LINE_BYTES
+
+        del self.lines[line]
+        return line_bytes(line)
+
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def clear(self) -> None:
+        self.lines.clear()
+
+
+class ScrollbackManager:
+    def __init__(self):
+        # No limit if 0
+        self.budget = 0
+        # Backends by the time they were last viewed
+        self.terminals = {}
+        self.last_enforce = 0
+
+    def register(self, backend) -> None:
+        self.terminals[backend] = time.monotonic()
+
+    def unregister(self, backend) -> None:
+        self.terminals.pop(backend, None)
+
+    def viewed(self, backend) -> None:
+        if backend in self.terminals:
+            self.terminals[backend] = time.monotonic()
+
+    def usage(self, backend) -> int:
+        return backend.screen.history_bytes + backend.buffer_screen.history_bytes
+
+    def viewed_times(self) -> dict:
+        # Terminals are unregistered by their reading thread when they
+        # close, the copy is made at once under the GIL
+        return self.terminals.copy()
+
+    def total(self) -> int:
+        return sum(map(self.usage, self.viewed_times()))
+
+    def enforce(self, now: float) -> None:
+        if not self.budget or now - self.last_enforce < ENFORCE_INTERVAL:
+            return
+        self.last_enforce = now
+
+        excess = self.total() - self.budget
+        if excess <= 0:
+            return
+
+        terminals = self.viewed_times()
+        backends = sorted(terminals, key=terminals.get)
+        for shrink in ("compress_history", "drop_history"):
+            for backend in backends:
+                with backend.feed_lock:
+                    for screen in (backend.screen, backend.buffer_screen):
+                        excess -= getattr(screen, shrink)(excess)
+                        if excess <= 0:
+                            return
+
+    def summary(self, current) -> str:
+        lines = []
+        terminals = self.viewed_times()
+        for backend in sorted(terminals, key=terminals.get, reverse=True):
+            screen = backend.screen
+            marker = "*" if backend is current else " "
+            lines.append(
+                f"{marker} {backend.title() or 'Terminal'}: "
+                f"{format_bytes(self.usage(backend))}, "
+                f"{len(screen.history.top)} lines, "
+                f"{len(screen.history_table.lines)} unique, "
+                f"{screen.history_compressed} compressed, "
+                f"{screen.history_table.hit_rate():.0%} shared"
+            )
+
+        budget = format_bytes(self.budget) if self.budget else "no limit"
+        lines.insert(0, f"Scrollback: {format_bytes(self.total())} of {budget}")
+        return "\n".join(lines)
+
+
+scrollback = ScrollbackManager()
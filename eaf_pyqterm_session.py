@@ -0,0 +1,330 @@
+# Copyright (C) 2023 by Mumulhl <mumulhl@duck.com>
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+"""On-disk scrollback of a terminal.
+
+A session file is ``MAGIC`` followed by append-only records, each one
+prefixed with a u32 length and a record type:
+
+- ``S``: u32 style id, then the style attributes joined by ``STYLE_SEPARATOR``.
+- ``L``: u16 run count, then every run as u32 style id, u16 byte length
+  and UTF-8 text, wide character stubs are stored as ``STUB``.
+
+Line records are decoded only when displayed, so restoring a big
+scrollback is a single scan over the record lengths of a mmap.
+"""
+
+import hashlib
+import mmap
+import os
+import platform
+import struct
+import time
+import unicodedata
+
+from pyte.screens import Char
+
+from eaf_pyqterm_utils import LoadedLines, get_wide_mask
+
+if platform.system() != "Windows":
+    import fcntl
+
+MAGIC = b"EAFPQTS2"
+# Session files of older versions are started again
+MAGIC_PREFIX = MAGIC[:-1]
+STYLE_RECORD = ord("S")
+LINE_RECORD = ord("L")
+STYLE_SEPARATOR = "\x1f"
+STUB = "\x00"
+FLUSH_INTERVAL = 1
+DEFAULT_CHAR = Char(" ")
+DEFAULT_STYLE = DEFAULT_CHAR[1:]
+
+RECORD_HEADER = struct.Struct("<IB")
+RUN_COUNT = struct.Struct("<H")
+RUN_HEADER = struct.Struct("<IH")
+STYLE_ID = struct.Struct("<I")
+
+# Restored and compressed lines kept decoded at most, for all terminals
+LOADED_LINES = 1024
+loaded_lines = LoadedLines(LOADED_LINES)
+
+
+def session_key(argv: list[str], start_directory: str) -> str:
+    key = "\0".join([start_directory, *argv]).encode()
+    return hashlib.sha1(key).hexdigest()[:16]
+
+
+def session_path(directory: str, argv: list[str], start_directory: str) -> str:
+    """Session file of a terminal, the same command in the same directory
+    gets back its scrollback."""
+    name = session_key(argv, start_directory)
+    return os.path.join(os.path.expanduser(directory), name)
+
+
+def encode_style(style: tuple) -> bytes:
+    return STYLE_SEPARATOR.join(map(str, style)).encode()
+
+
+def decode_style(data: bytes) -> tuple:
+    fg, bg, *flags = data.decode().split(STYLE_SEPARATOR)
+    return (fg, bg, *(flag == "True" for flag in flags))
+
+
+def iter_runs(line) -> list[tuple[tuple, str]]:
+    """Split a line into runs of ``(style, text)``."""
+    if not line:
+        return []
+
+    runs = []
+    style = None
+    text = []
+    for x in range(max(line) + 1):
+        char = line[x]
+        char_style = char[1:]
+        if char_style != style:
+            if text:
+                runs.append((style, "".join(text)))
+            style = char_style
+            text = []
+        text.append(char.data or STUB)
+    runs.append((style, "".join(text)))
+
+    # Drop trailing blanks
+    style, text = runs[-1]
+    if style == DEFAULT_STYLE:
+        text = text.rstrip(" ")
+        if text:
+            runs[-1] = (style, text)
+        else:
+            runs.pop()
+
+    return runs
+
+
+def decode_runs(runs) -> dict[int, Char]:
+    """Reverse of ``iter_runs``."""
+    line = {}
+    x = 0
+    for style, text in runs:
+        for char in text:
+            if unicodedata.combining(char) and x > 0:
+                last = line[x - 1]
+                line[x - 1] = last._replace(data=last.data + char)
+                continue
+
+            line[x] = Char("" if char == STUB else char, *style)
+            x += 1
+
+    return line
+
+
+class SessionLine(dict):
+    """A history line which is decoded from the session file on use."""
+
+    __slots__ = ("session", "offset", "default", "wide_mask", "loaded")
+
+    # Links are not saved
+    links = None
+    # Estimated memory, the line is on disk unless it's one of the loaded
+    # lines
+    size = 200
+
+    def __init__(self, session, offset: int):
+        self.session = session
+        self.offset = offset
+        self.default = DEFAULT_CHAR
+        self.wide_mask = 0
+        self.loaded = False
+
+    def load(self) -> None:
+        if not self.loaded:
+            self.loaded = True
+            self.update(self.session.decode_line(self.offset))
+            self.wide_mask = get_wide_mask(self)
+            loaded_lines.add(self)
+
+    def unload(self) -> None:
+        # Marked first, so a line read meanwhile is loaded again
+        self.loaded = False
+        self.clear()
+
+    @property
+    def wide(self) -> int:
+        self.load()
+        return self.wide_mask
+
+    def __missing__(self, key: int) -> Char:
+        if not self.loaded:
+            self.load()
+            if key in self:
+                return self[key]
+        return self.default
+
+
+class Session:
+    def __init__(self, path: str, max_lines: int):
+        self.path = path
+        self.max_lines = max_lines
+
+        self.styles: dict[tuple, int] = {}
+        self.style_list: list[tuple] = []
+        self.line_offsets: list[int] = []
+        self.mmap = None
+        self.last_flush = time.time()
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.file = open(path, "a+b")
+        try:
+            self.lock()
+            self.load()
+        except:  # noqa: E722
+            self.file.close()
+            raise
+
+    def lock(self) -> None:
+        # Raise BlockingIOError if another terminal is using this session
+        if platform.system() != "Windows":
+            fcntl.flock(self.file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+    def load(self) -> None:
+        size = os.fstat(self.file.fileno()).st_size
+        if size < len(MAGIC):
+            self.file.truncate(0)
+            self.file.write(MAGIC)
+            return
+
+        self.mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.mmap[: len(MAGIC)] != MAGIC:
+            if self.mmap[: len(MAGIC_PREFIX)] != MAGIC_PREFIX:
+                raise ValueError(f"{self.path} is not a session file")
+
+            self.mmap.close()
+            self.mmap = None
+            self.file.truncate(0)
+            self.file.write(MAGIC)
+            return
+
+        end = self.scan()
+        if end != size:
+            # The last record was cut off by a crash
+            self.file.truncate(end)
+
+        if len(self.line_offsets) > self.max_lines * 2:
+            self.compact()
+
+    def scan(self) -> int:
+        data = self.mmap
+        size = len(data)
+        offset = len(MAGIC)
+        while offset + RECORD_HEADER.size <= size:
+            length, record_type = RECORD_HEADER.unpack_from(data, offset)
+            end = offset + 4 + length
+            if length == 0 or end > size:
+                break
+
+            if record_type == LINE_RECORD:
+                self.line_offsets.append(offset + RECORD_HEADER.size)
+            elif record_type == STYLE_RECORD:
+                start = offset + RECORD_HEADER.size
+                # Style ids are allocated sequentially
+                style = decode_style(data[start + STYLE_ID.size : end])
+                self.styles[style] = len(self.style_list)
+                self.style_list.append(style)
+            offset = end
+
+        return offset
+
+    def compact(self) -> None:
+        """Keep only the last ``max_lines`` lines on disk, and the styles
+        they use."""
+        data = self.mmap
+        records = []
+        style_ids: dict[int, int] = {}
+        for offset in self.line_offsets[-self.max_lines :]:
+            (count,) = RUN_COUNT.unpack_from(data, offset)
+            record = [RUN_COUNT.pack(count)]
+            offset += RUN_COUNT.size
+            for _ in range(count):
+                style_id, length = RUN_HEADER.unpack_from(data, offset)
+                offset += RUN_HEADER.size
+                style_id = style_ids.setdefault(style_id, len(style_ids))
+                record.append(RUN_HEADER.pack(style_id, length))
+                record.append(data[offset : offset + length])
+                offset += length
+            payload = b"".join(record)
+            records.append(RECORD_HEADER.pack(len(payload) + 1, LINE_RECORD) + payload)
+
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "wb") as tmp:
+            tmp.write(MAGIC)
+            for old_id, style_id in style_ids.items():
+                tmp.write(self.style_record(style_id, self.style_list[old_id]))
+            tmp.writelines(records)
+        os.replace(tmp_path, self.path)
+
+        self.mmap.close()
+        self.file.close()
+        self.file = open(self.path, "a+b")
+        self.lock()
+        self.styles = {}
+        self.style_list = []
+        self.line_offsets = []
+        self.mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.scan()
+
+    def restored_lines(self) -> list[SessionLine]:
+        return [
+            SessionLine(self, offset) for offset in self.line_offsets[-self.max_lines :]
+        ]
+
+    def decode_line(self, offset: int) -> dict[int, Char]:
+        data = self.mmap
+        (count,) = RUN_COUNT.unpack_from(data, offset)
+        offset += RUN_COUNT.size
+
+        runs = []
+        for _ in range(count):
+            style_id, length = RUN_HEADER.unpack_from(data, offset)
+            offset += RUN_HEADER.size
+            text = data[offset : offset + length].decode()
+            offset += length
+            runs.append((self.style_list[style_id], text))
+
+        return decode_runs(runs)
+
+    def style_record(self, style_id: int, style: tuple) -> bytes:
+        payload = STYLE_ID.pack(style_id) + encode_style(style)
+        return RECORD_HEADER.pack(len(payload) + 1, STYLE_RECORD) + payload
+
+    def style_id(self, style: tuple) -> int:
+        style_id = self.styles.get(style)
+        if style_id is None:
+            style_id = len(self.style_list)
+            self.styles[style] = style_id
+            self.style_list.append(style)
+            self.file.write(self.style_record(style_id, style))
+        return style_id
+
+    def append_line(self, line) -> None:
+        runs = iter_runs(line)
+        payload = [RUN_COUNT.pack(len(runs))]
+        for style, text in runs:
+            data = text.encode()
+            payload.append(RUN_HEADER.pack(self.style_id(style), len(data)))
+            payload.append(data)
+        payload = b"".join(payload)
+
+        self.file.write(RECORD_HEADER.pack(len(payload) + 1, LINE_RECORD) + payload)
+
+        now = time.time()
+        if now - self.last_flush > FLUSH_INTERVAL:
+            self.last_flush = now
+            self.file.flush()
+
+    def close(self) -> None:
+        # The mmap holds a duplicate of the fd and so the lock, it stays
+        # open for the restored lines which aren't decoded yet
+        if platform.system() != "Windows":
+            fcntl.flock(self.file, fcntl.LOCK_UN)
+        self.file.close()
@@ -1,35 +1,373 @@
 # Copyright (C) 2023 by Mumulhl <mumulhl@duck.com>
 # SPDX-License-Identifier: GPL-3.0-or-later
 
+import bisect
+import copy
 import re
-import threading
+import struct
 import time
+import unicodedata
+import weakref
+from collections import defaultdict
+from itertools import islice
+from typing import Callable, Iterable
 
 import pyte
-from core.utils import *
-from PyQt6.QtWidgets import QApplication
-from pyte.screens import Cursor, HistoryScreen
+from pyte import charsets as cs
+from pyte import modes as mo
+from pyte.screens import (
+    Char,
+    Cursor,
+    HistoryScreen,
+    Margins,
+    Screen,
+    StaticDefaultDict,
+    wcwidth,
+)
 from pyte.streams import ByteStream
-from eaf_pyqterm_utils import get_regexp
+from eaf_pyqterm_export import text_line
+from eaf_pyqterm_minimap import Overview, line_summary
+from eaf_pyqterm_scrollback import CompressedLine, LineTable, line_bytes
+from eaf_pyqterm_session import SessionLine
+from eaf_pyqterm_utils import get_regexp, get_run_regexp, get_wide_mask, is_wide
+
+# Shorter runs aren't worth leaving the state machine for
+PRINTABLE_RUN = re.compile(rb"[\x20-\x7e]{8,}")
+PRINTABLE_ASCII = "".join(map(chr, range(0x20, 0x7F)))
+
+# OSC sequences pyte doesn't parse, terminated by BEL or ST
+OSC_SEQUENCE = re.compile(rb"\x1b\](133|8);([^\x07\x1b]*)(?:\x07|\x1b\\)")
+OSC_PREFIXES = (b"\x1b]133;", b"\x1b]8;")
+OSC_MAX_LENGTH = 4096
+OSC_HANDLERS = {b"133": "prompt_mark", b"8": "set_link"}
+
+PROMPT_MARKS = "ABCD"
+MAX_TRIGGER_LINES = 4096
+
+# Lines overwritten with carriage returns, like progress bars
+OVERWRITTEN_LINE = re.compile(rb"[^\n]*\r(?!\n)[^\n]*")
+# Text which stays on the line, only SGR and erase line to the right or
+# entirely are allowed
+OVERWRITE_SEGMENT = re.compile(
+    rb"(?:[\x20-\x7e\x80-\xff]|\x1b\[[0-9;]*m|\x1b\[[02]?K)*"
+)
+SGR_SEQUENCE = re.compile(rb"\x1b\[[0-9;]*m")
+# Insert mode shifts the text instead of overwriting it
+INSERT_MODE = re.compile(rb"\x1b\[(?:[0-9;]*;)?4(?:;[0-9;]*)?h")
+ERASE_LINE_SEQUENCE = re.compile(rb"\x1b\[[02]?K")
+
+
+def ignore(*args) -> None:
+    pass
+
+
+class WidthTable(dict):
+    """Width of characters, computed once for every character."""
+
+    def __missing__(self, char: str) -> int:
+        width = self[char] = wcwidth(char)
+        return width
+
+
+CHAR_WIDTHS = WidthTable()
+
+
+def segment_width(segment: bytes) -> int:
+    """Width of the text of an overwrite segment, -1 if it can't be
+    known."""
+    text = SGR_SEQUENCE.sub(b"", segment)
+    if text.isascii():
+        return len(text)
+
+    try:
+        widths = [CHAR_WIDTHS[char] for char in text.decode()]
+    except UnicodeDecodeError:
+        return -1
+    return -1 if -1 in widths else sum(widths)
+
+
+def collapse_line(line: bytes, columns: int) -> bytes:
+    """Drop the segments of ``line`` which are overwritten by later ones
+    after a carriage return, their SGR sequences are kept."""
+    segments = line.split(b"\r")
+
+    # Width from column 0 covered by the later segments, the last segment
+    # is always kept as its carriage return moves the cursor
+    cover = -1
+    kept = []
+    for segment in reversed(segments[1:]):
+        width = -1
+        if OVERWRITE_SEGMENT.fullmatch(segment):
+            width = segment_width(segment)
+
+        if width < 0 or width > columns:
+            # The cursor may leave the line, nothing before is covered
+            cover = 0
+        else:
+            if ERASE_LINE_SEQUENCE.search(segment):
+                width = columns
+            if width <= cover:
+                kept.append(b"".join(SGR_SEQUENCE.findall(segment)))
+                continue
+            cover = width
+
+        kept.append(b"\r" + segment)
+
+    kept.append(segments[0])
+    return b"".join(reversed(kept))
+
+
+def collapse_overwrites(data: bytes, columns: int) -> bytes:
+    """Collapse the updates of progress bars to their last state, so they
+    aren't all parsed and drawn. The screen must not be in insert mode,
+    see ``TerminalStream.can_collapse``."""
+    if data.count(b"\r") == data.count(b"\r\n") or INSERT_MODE.search(data):
+        return data
+
+    return OVERWRITTEN_LINE.sub(lambda match: collapse_line(match[0], columns), data)
+
+
+class Link:
+    __slots__ = ("url", "__weakref__")
+
+    def __init__(self, url: str):
+        self.url = url
+
+
+# Lines refer to the links of their cells, so a link is freed with the
+# last line using it
+LINKS: weakref.WeakValueDictionary[str, Link] = weakref.WeakValueDictionary()
+
+
+def intern_link(url: str) -> Link:
+    link = LINKS.get(url)
+    if link is None:
+        link = LINKS[url] = Link(url)
+    return link
+
+
+class TerminalLine(StaticDefaultDict):
+    """A line which keeps the bitmap of its wide characters in ``wide``
+    up to date, see ``get_wide_mask``, and the OSC 8 links of its cells
+    in ``links``. Writing a cell removes its link."""
+
+    def __init__(self, default: Char):
+        super().__init__(default)
+        self.wide = 0
+        self.links: dict[int, Link] | None = None
+
+    def __setitem__(self, x: int, char: Char) -> None:
+        dict.__setitem__(self, x, char)
+        if self.links:
+            self.links.pop(x, None)
+        if x > 0:
+            if char.data == "":
+                self.wide |= 1 << (x - 1)
+            elif self.wide:
+                self.wide &= ~(1 << (x - 1))
+
+    def __delitem__(self, x: int) -> None:
+        dict.__delitem__(self, x)
+        if self.links:
+            self.links.pop(x, None)
+        if self.wide and x > 0:
+            self.wide &= ~(1 << (x - 1))
+
+    def pop(self, x: int, *default) -> Char:
+        char = dict.pop(self, x, *default)
+        if self.links:
+            self.links.pop(x, None)
+        if self.wide and x > 0:
+            self.wide &= ~(1 << (x - 1))
+        return char
+
+    def clear(self) -> None:
+        dict.clear(self)
+        self.wide = 0
+        self.links = None
+
+    def update(self, *args, **kwargs) -> None:
+        chars = dict(*args, **kwargs)
+        dict.update(self, chars)
+        self.wide = get_wide_mask(self)
+        if self.links:
+            for x in chars:
+                self.links.pop(x, None)
+
+    def __copy__(self) -> "TerminalLine":
+        # Filling the copy through __setitem__ would remove the links of
+        # the line, so it gets its own links
+        line = TerminalLine(self.default)
+        dict.update(line, self)
+        line.wide = self.wide
+        if self.links:
+            line.links = dict(self.links)
+        return line
+
+    def set_link(self, x: int, link: Link) -> None:
+        if self.links is None:
+            self.links = {}
+        self.links[x] = link
+
+    def fill_ascii(
+        self, x: int, count: int, chars: Iterable[Char], link: Link | None = None
+    ) -> None:
+        """Write ``count`` narrow characters from x."""
+        dict.update(self, zip(range(x, x + count), chars))
+        if self.wide:
+            self.wide &= ~((((1 << count) - 1) << x) >> 1)
+
+        if self.links:
+            for column in range(x, x + count):
+                self.links.pop(column, None)
+        if link:
+            if self.links is None:
+                self.links = {}
+            self.links.update(dict.fromkeys(range(x, x + count), link))
+
+
+class HistoryLine(TerminalLine):
+    """An immutable line of the history, identical lines are shared, see
+    ``LineTable``."""
+
+    # Boundaries of things by thing and width, see ``get_boundaries``
+    boundaries = None
+    # See ``line_summary``
+    summary = None
+
+    @classmethod
+    def freeze(cls, line: TerminalLine) -> "HistoryLine":
+        """Turn ``line``, which has left the screen, into a history line
+        without copying it."""
+        line.__class__ = cls
+        # Lines without links compare equal however their links went away
+        if not line.links:
+            line.links = None
+        # Equal lines may have been written in a different order
+        line.hash = hash((frozenset(dict.items(line)), line.default))
+        return line
+
+    def __hash__(self) -> int:
+        return self.hash
+
+    def __eq__(self, other) -> bool:
+        return (
+            dict.__eq__(self, other)
+            and self.links == other.links
+            and self.default == other.default
+        )
+
+    def _immutable(self, *args, **kwargs):
+        raise TypeError("History lines are immutable")
+
+    __setitem__ = __delitem__ = pop = clear = update = _immutable
+    setdefault = popitem = set_link = fill_ascii = _immutable
+
+
+def thing_boundaries(line, pattern: re.Pattern, columns: int) -> tuple:
+    """Columns of the separators after and before the things of a line,
+    the columns before and after the line included, and the end of its
+    text like ``get_end_x``."""
+    # One character per cell, wide character stubs are part of things
+    text = "".join((line[x].data or "\0")[0] for x in range(columns + 1))
+
+    ends = []
+    starts = []
+    for match in pattern.finditer(text):
+        starts.append(match.start() - 1)
+        ends.append(match.end())
+    return ends, starts, len(text[:columns].rstrip(" "))
 
 
 class TerminalStream(ByteStream):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
+        # The start of an OSC sequence at the end of the last data
+        self.pending = b""
+
+    def can_draw_directly(self) -> bool:
+        # Not inside an escape sequence or a multibyte character
+        return (
+            self._taking_plain_text
+            and self.use_utf8
+            and not self.utf8_decoder.getstate()[0]
+        )
+
+    def can_collapse(self) -> bool:
+        """Whether the next data can go through ``collapse_overwrites``,
+        not in insert mode nor inside an escape sequence."""
+        return (
+            not self.pending
+            and self._taking_plain_text
+            and mo.IRM not in self.listener.mode
+        )
+
+    def feed(self, data: bytes) -> None:
+        """Handle the OSC sequences which pyte doesn't parse."""
+        if self.pending:
+            data = self.pending + data
+            self.pending = b""
+
+        offset = 0
+        for match in OSC_SEQUENCE.finditer(data):
+            self.feed_runs(data[offset : match.start()])
+            handler = getattr(self.listener, OSC_HANDLERS[match[1]])
+            handler(match[2].decode(errors="replace"))
+            offset = match.end()
+
+        # Keep a sequence cut off at the end for the next data
+        start = data.rfind(b"\x1b]", offset)
+        tail = data[start:]
+        if (
+            start == -1
+            or len(tail) > OSC_MAX_LENGTH
+            or b"\x07" in tail
+            or b"\x1b\\" in tail
+            or not any(
+                prefix.startswith(tail) or tail.startswith(prefix)
+                for prefix in OSC_PREFIXES
+            )
+        ):
+            start = len(data) - 1 if data.endswith(b"\x1b") else -1
+
+        if start >= offset:
+            self.pending = data[start:]
+            data = data[:start]
+
+        self.feed_runs(data[offset:])
+
+    def feed_runs(self, data: bytes) -> None:
+        """Draw long runs of printable ASCII without the state machine."""
+        draw_ascii = self.listener.draw_ascii
+        offset = 0
+
+        for match in PRINTABLE_RUN.finditer(data):
+            start, end = match.span()
+            if start > offset:
+                super().feed(data[offset:start])
+
+            if self.can_draw_directly():
+                draw_ascii(data[start:end].decode("ascii"))
+            else:
+                super().feed(data[start:end])
+            offset = end
+
+        if offset < len(data):
+            super().feed(data[offset:])
+
 
 class TerminalScreen(HistoryScreen):
     def __init__(self, is_buffer, columns, lines, history):
         super().__init__(columns, lines, history)
 
+        self.buffer = defaultdict(lambda: TerminalLine(self.default_char))
+
         self.is_buffer = is_buffer
 
         self.base = 0
         self.in_history = False
 
-        self.auto_scroll_lock = True
-        self.current_thread = None
-
         self.cursor_move_mode = False
         self.before_is_cursor_move_mode = False
 
@@ -43,9 +381,395 @@ class TerminalScreen(HistoryScreen):
         self.virtual_cursor = Cursor(0, 0)
         self.old_cursor = Cursor(0, 0)
         self.old_marker_cursor = Cursor(0, 0)
+        self.selection: dict[int, range] = {}
+        self.selection_key = None
 
         self.mouse = False
 
+        self.session = None
+        self.notifier = None
+
+        # Callbacks of the frontend, the screen runs without them
+        self.on_bell: Callable[[], None] = ignore
+        self.on_message: Callable[[str], None] = ignore
+        self.on_clipboard: Callable[[str], None] = ignore
+        self.on_cursor_move_mode: Callable[[bool], None] = ignore
+        self.on_trigger: Callable[[str, str, int], None] = ignore
+
+        # Output triggers, see eaf_pyqterm_trigger, and the lines which
+        # matched, numbered from the first line ever like prompt marks
+        self.triggers = None
+        self.trigger_lines: set[int] = set()
+
+        # Lines pushed out of the history, marks are numbered from the
+        # first line ever, so they stay valid when the history drops lines
+        self.history_dropped = 0
+        # Estimated memory of the history, and the count of its oldest
+        # lines which are compressed or shared
+        self.history_bytes = 0
+        self.history_compressed = 0
+        self.history_table = LineTable()
+        # Summaries of the history for the minimap, only kept once enabled
+        self.overview: Overview | None = None
+        self.prompt_marks: dict[str, list[int]] = {kind: [] for kind in PROMPT_MARKS}
+
+        self.ascii_chars_cache: dict[Char, dict[str, Char]] = {}
+
+    def reset(self) -> None:
+        super().reset()
+
+        # The OSC 8 link of the characters being drawn
+        self.link: Link | None = None
+
+    def ascii_chars(self, attrs: Char) -> dict[str, Char]:
+        """Printable ASCII characters with the attributes of ``attrs``."""
+        chars = self.ascii_chars_cache.get(attrs)
+        if chars is None:
+            if len(self.ascii_chars_cache) > 256:
+                self.ascii_chars_cache.clear()
+
+            chars = {char: attrs._replace(data=char) for char in PRINTABLE_ASCII}
+            self.ascii_chars_cache[attrs] = chars
+        return chars
+
+    def draw(self, data: str) -> None:
+        """Same as ``Screen.draw``, but the widths of characters are looked
+        up in ``CHAR_WIDTHS``."""
+        data = data.translate(self.g1_charset if self.charset else self.g0_charset)
+
+        cursor = self.cursor
+        columns = self.columns
+        autowrap = mo.DECAWM in self.mode
+        insert = mo.IRM in self.mode
+        link = self.link
+
+        for char in data:
+            char_width = CHAR_WIDTHS[char]
+
+            if cursor.x == columns:
+                if autowrap:
+                    self.dirty.add(cursor.y)
+                    self.carriage_return()
+                    self.linefeed()
+                elif char_width > 0:
+                    cursor.x -= char_width
+
+            if insert and char_width > 0:
+                self.insert_characters(char_width)
+
+            line = self.buffer[cursor.y]
+            if char_width == 1:
+                line[cursor.x] = cursor.attrs._replace(data=char)
+                if link:
+                    line.set_link(cursor.x, link)
+            elif char_width == 2:
+                # A two-cell character has a stub slot after it
+                line[cursor.x] = cursor.attrs._replace(data=char)
+                if link:
+                    line.set_link(cursor.x, link)
+                if cursor.x + 1 < columns:
+                    line[cursor.x + 1] = cursor.attrs._replace(data="")
+                    if link:
+                        line.set_link(cursor.x + 1, link)
+            elif char_width == 0 and unicodedata.combining(char):
+                # Combine with the previous character on this or the
+                # preceding line
+                if cursor.x:
+                    last = line[cursor.x - 1]
+                    normalized = unicodedata.normalize("NFC", last.data + char)
+                    line[cursor.x - 1] = last._replace(data=normalized)
+                elif cursor.y:
+                    last = self.buffer[cursor.y - 1][columns - 1]
+                    normalized = unicodedata.normalize("NFC", last.data + char)
+                    self.buffer[cursor.y - 1][columns - 1] = last._replace(
+                        data=normalized
+                    )
+            else:
+                break  # Unprintable character or doesn't advance the cursor
+
+            if char_width > 0:
+                cursor.x = min(cursor.x + char_width, columns)
+
+        self.dirty.add(cursor.y)
+
+    def draw_ascii(self, data: str) -> None:
+        """Fast path of ``draw`` for printable ASCII, fill the line storage
+        one run at a time instead of one character at a time."""
+        if self.charset or self.g0_charset is not cs.LAT1_MAP or mo.IRM in self.mode:
+            self.draw(data)
+            return
+
+        cursor = self.cursor
+        columns = self.columns
+        chars = self.ascii_chars(cursor.attrs)
+        autowrap = mo.DECAWM in self.mode
+
+        offset = 0
+        length = len(data)
+        while offset < length:
+            if cursor.x >= columns:
+                if not autowrap:
+                    # The rest of data overwrites the last column
+                    self.buffer[cursor.y][columns - 1] = chars[data[-1]]
+                    break
+
+                self.dirty.add(cursor.y)
+                self.carriage_return()
+                self.linefeed()
+
+            x = cursor.x
+            count = min(columns - x, length - offset)
+            self.buffer[cursor.y].fill_ascii(
+                x,
+                count,
+                map(chars.__getitem__, data[offset : offset + count]),
+                self.link,
+            )
+            offset += count
+            cursor.x = x + count
+
+        self.dirty.add(cursor.y)
+
+    def _reset_history(self) -> None:
+        super()._reset_history()
+
+        if hasattr(self, "prompt_marks"):
+            self.trigger_lines.clear()
+            self.history_dropped = 0
+            self.history_bytes = 0
+            self.history_compressed = 0
+            self.history_table.clear()
+            if self.overview is not None:
+                self.overview.clear()
+            for marks in self.prompt_marks.values():
+                marks.clear()
+
+    def push_history(self, line) -> None:
+        top = self.history.top
+        if len(top) == top.maxlen:
+            self.history_dropped += 1
+            self.history_bytes -= self.release_history_line(top[0])
+            self.history_compressed = max(self.history_compressed - 1, 0)
+            if self.overview is not None:
+                self.overview.drop(1)
+
+        history_line, size = self.history_table.intern(HistoryLine.freeze(line))
+        top.append(history_line)
+        self.history_bytes += size
+
+        if self.overview is not None:
+            if history_line.summary is None:
+                history_line.summary = line_summary(history_line)
+            self.overview.append(history_line.summary)
+
+        if self.session:
+            try:
+                self.session.append_line(line)
+            except (OSError, ValueError, struct.error):
+                # The scrollback isn't saved anymore, but the terminal
+                # goes on
+                self.session = None
+
+    def release_history_line(self, line) -> int:
+        """Bytes freed by removing ``line`` from the history."""
+        if type(line) is HistoryLine:
+            return self.history_table.release(line)
+        return line_bytes(line)
+
+    def extend_history(self, lines: list) -> None:
+        self.history.top.extend(lines)
+        self.history_bytes += sum(map(line_bytes, lines))
+        if self.overview is not None:
+            self.overview.extend_unknown(len(lines))
+
+    def enable_overview(self) -> None:
+        """Keep summaries of the history, the lines already in it are
+        summarized when the minimap samples them."""
+        if self.overview is None:
+            self.overview = Overview()
+            self.overview.extend_unknown(len(self.history.top))
+
+    def history_summary(self, index: int) -> tuple[int, str]:
+        line = self.history.top[index]
+        # Don't keep restored lines decoded for a summary
+        if type(line) is SessionLine and not line.loaded:
+            line = line.session.decode_line(line.offset)
+        return line_summary(line)
+
+    def compress_history(self, excess: int) -> int:
+        """Compress the oldest lines of the history until ``excess`` bytes
+        are freed, the lines of the last page are kept as they are."""
+        top = self.history.top
+        freed = 0
+        end = len(top) - self.lines
+        while freed < excess and self.history_compressed < end:
+            line = top[self.history_compressed]
+            # Shared lines are already small
+            if type(line) is HistoryLine and self.history_table.uses(line) == 1:
+                compressed = CompressedLine(line)
+                top[self.history_compressed] = compressed
+                freed += self.history_table.release(line) - compressed.size
+            self.history_compressed += 1
+
+        self.history_bytes -= freed
+        return freed
+
+    def drop_history(self, excess: int) -> int:
+        """Drop the oldest lines of the history until ``excess`` bytes are
+        freed."""
+        top = self.history.top
+        freed = 0
+        count = 0
+        while freed < excess and top:
+            freed += self.release_history_line(top.popleft())
+            count += 1
+
+        self.history_bytes -= freed
+        self.history_dropped += count
+        self.history_compressed = max(self.history_compressed - count, 0)
+        if self.overview is not None:
+            self.overview.drop(count)
+        self.base = max(self.base - count, 0)
+        self.absolute_virtual_cursor_y = max(self.absolute_virtual_cursor_y - count, 0)
+        if self.marker:
+            x, y = self.marker
+            self.marker = (x, max(y - count, 0))
+        if count:
+            self.dirty.update(range(self.lines))
+        return freed
+
+    def index(self) -> None:
+        top, bottom = self.margins or Margins(0, self.lines - 1)
+
+        if self.cursor.y == bottom:
+            self.push_history(self.buffer[top])
+
+        # Skip HistoryScreen.index, push_history has saved the line
+        Screen.index(self)
+
+    def linefeed(self) -> None:
+        # The line is complete once the cursor leaves it
+        if self.triggers:
+            self.check_triggers(self.cursor.y)
+        super().linefeed()
+
+    def check_triggers(self, y: int) -> None:
+        """Match the line ``y`` of the screen against the triggers, a line
+        only triggers once."""
+        text = self.get_line_display(y, in_buffer=True).strip()
+        name = self.triggers.match(text)
+        if name is None:
+            return
+
+        line_num = self.history_dropped + len(self.history.top) + y
+        if line_num in self.trigger_lines:
+            return
+        if len(self.trigger_lines) > MAX_TRIGGER_LINES:
+            self.trigger_lines = {
+                n for n in self.trigger_lines if n >= self.history_dropped
+            }
+        self.trigger_lines.add(line_num)
+        self.dirty.add(y)
+
+        # The line tells apart firings with the same text, which the
+        # notifier would take for the last one sent
+        if self.triggers.ready(name, time.monotonic()):
+            if self.notifier:
+                self.notifier.post(
+                    f"trigger {name}", self.on_trigger, name, text, line_num
+                )
+            else:
+                self.on_trigger(name, text, line_num)
+
+    def is_trigger_line(self, line_num: int) -> bool:
+        return self.history_dropped + self.absolute_y(line_num) in self.trigger_lines
+
+    def erase_in_display(self, how: int = 0, *args, **kwargs) -> None:
+        # Erased lines aren't pushed to the history, so the text drawn
+        # again on them is a new firing
+        if self.trigger_lines:
+            if how == 0:
+                erased = range(self.cursor.y + 1, self.lines)
+            elif how == 1:
+                erased = range(self.cursor.y)
+            else:
+                erased = range(self.lines)
+            first = self.history_dropped + len(self.history.top)
+            self.trigger_lines.difference_update(first + y for y in erased)
+
+        super().erase_in_display(how, *args, **kwargs)
+
+    def set_link(self, param: str) -> None:
+        """Start an OSC 8 link, or end it if the URL is empty."""
+        _, _, url = param.partition(";")
+        self.link = intern_link(url) if url else None
+
+    def prompt_mark(self, param: str) -> None:
+        """Record an OSC 133 mark at the line of the cursor."""
+        kind = param[:1]
+        if kind not in self.prompt_marks:
+            return
+
+        line = self.history_dropped + len(self.history.top) + self.cursor.y
+
+        # The marks after it were redrawn, e.g. by clear, a new prompt
+        # also ends the marks of the last command on its line
+        marks = self.prompt_marks[kind]
+        del marks[bisect.bisect_left(marks, line) :]
+        if kind == "A":
+            for marks in self.prompt_marks.values():
+                del marks[bisect.bisect_right(marks, line) :]
+
+        self.prompt_marks[kind].append(line)
+
+    def find_prompt(self, line_num: int, reverse: bool = False) -> int | None:
+        """Absolute line of the prompt before or after the absolute line."""
+        marks = self.prompt_marks["A"]
+        line_num += self.history_dropped
+
+        if reverse:
+            index = bisect.bisect_left(marks, line_num) - 1
+            if index < 0 or marks[index] < self.history_dropped:
+                return None
+        else:
+            index = bisect.bisect_right(marks, line_num)
+            if index == len(marks):
+                return None
+
+        return marks[index] - self.history_dropped
+
+    def get_last_output_range(self) -> tuple[tuple[int, int], tuple[int, int]] | None:
+        """Range of the output of the last command, which ends before the
+        next prompt or at the cursor if the command is still running."""
+        starts = self.prompt_marks["C"]
+        dropped = self.history_dropped
+        if not starts or starts[-1] < dropped:
+            return None
+        start_y = starts[-1]
+
+        end_y = self.history_dropped + len(self.history.top) + self.cursor.y
+        for kind in "DA":
+            marks = self.prompt_marks[kind]
+            index = bisect.bisect_left(marks, start_y)
+            if index < len(marks):
+                end_y = min(end_y, marks[index] - 1)
+
+        if end_y < start_y:
+            return None
+        return (0, start_y - dropped), (self.columns, end_y - dropped)
+
+    def goto_line(self, line_num: int) -> None:
+        """Scroll the absolute line into view and move the virtual cursor
+        to its beginning."""
+        if line_num < self.base:
+            self.scroll_up(self.base - line_num)
+        elif line_num >= self.base + self.lines:
+            self.scroll_down(line_num - self.base)
+
+        self.virtual_cursor.x = 0
+        self.virtual_cursor.y = line_num - self.base
+        self.max_virtual_cursor_x = 0
+
     def absolute_y(self, line_num: int) -> int:
         return self.base + line_num
 
@@ -59,7 +783,7 @@ class TerminalScreen(HistoryScreen):
         )
 
     def bell(self) -> None:
-        QApplication.beep()
+        self.on_bell()
 
     def sync_cursor(self) -> None:
         self.old_cursor.x = self.virtual_cursor.x
@@ -102,6 +826,16 @@ class TerminalScreen(HistoryScreen):
         if base != old_base:
             self.dirty.update(range(self.lines))
 
+    def scroll_to(self, base: int) -> None:
+        """Scroll so the screen starts at the absolute line ``base``."""
+        if not self.in_history:
+            self.base = len(self.history.top)
+
+        if base < self.base:
+            self.scroll_up(self.base - base)
+        elif base > self.base:
+            self.scroll_down(base - self.base)
+
     def scroll_to_begin(self) -> None:
         if self.is_buffer:
             return
@@ -208,7 +942,7 @@ class TerminalScreen(HistoryScreen):
                     continue
 
                 if y < count:
-                    self.history.top.append(line)
+                    self.push_history(line)
                 else:
                     self.buffer[y - count] = line
 
@@ -247,7 +981,13 @@ class TerminalScreen(HistoryScreen):
         self.fake_marker = False
         self.mouse = False
 
-        eval_in_emacs("eaf--toggle-cursor-move-mode", ["'t" if status else "'nil"])
+        self.notify_cursor_move_mode(status)
+
+    def notify_cursor_move_mode(self, status: bool) -> None:
+        if self.notifier:
+            self.notifier.post("cursor_move_mode", self.on_cursor_move_mode, status)
+        else:
+            self.on_cursor_move_mode(status)
 
     def adjust_x(self, y: int) -> None:
         """Recalibrate the x of the virtual cursor."""
@@ -273,7 +1013,6 @@ class TerminalScreen(HistoryScreen):
             self.scroll_down(1)
         else:
             self.virtual_cursor.y = y
-            self.dirty.add(y)
 
         self.adjust_x(self.virtual_cursor.y)
 
@@ -284,7 +1023,6 @@ class TerminalScreen(HistoryScreen):
             self.scroll_up(1)
         else:
             self.virtual_cursor.y = y
-            self.dirty.add(y)
 
         self.adjust_x(self.virtual_cursor.y)
 
@@ -294,7 +1032,7 @@ class TerminalScreen(HistoryScreen):
         line = self.get_line(self.virtual_cursor.y)
 
         # Skip two width character
-        if line[x].data == "":
+        if is_wide(line, x - 1):
             x += 1
 
         if x > end_x and not self.at_bottom():
@@ -310,7 +1048,7 @@ class TerminalScreen(HistoryScreen):
         end_x = self.get_end_x(self.virtual_cursor.y - 1)
         line = self.get_line(self.virtual_cursor.y)
 
-        if line[x].data == "":
+        if is_wide(line, x - 1):
             x -= 1
 
         if x < 0 and not self.at_top():
@@ -321,58 +1059,83 @@ class TerminalScreen(HistoryScreen):
             self.virtual_cursor.x = x
             self.max_virtual_cursor_x = x
 
+    def get_boundaries(self, y: int, thing: str) -> tuple:
+        """``thing_boundaries`` of the absolute line, which are kept on
+        history lines as they don't change."""
+        line = self.get_line(y, True)
+        pattern = get_run_regexp(thing)
+        if not isinstance(line, HistoryLine):
+            return thing_boundaries(line, pattern, self.columns)
+
+        if line.boundaries is None:
+            line.boundaries = {}
+        key = (thing, self.columns)
+        boundaries = line.boundaries.get(key)
+        if boundaries is None:
+            boundaries = thing_boundaries(line, pattern, self.columns)
+            line.boundaries[key] = boundaries
+        return boundaries
+
     def find(
-        self, y: int, pattern: re.Pattern, start: int, reverse: bool = False
+        self, y: int, thing: str, start: int | None = None, reverse: bool = False
     ) -> int | None:
-        line = self.get_line(y)
-        iterator = (
-            range(start - 1, -2, -1) if reverse else range(start, self.get_end_x(y) + 1)
-        )
-        string_match = False
-
-        for column in iterator:
-            pattern_match = bool(pattern.match(line[column].data))
+        """Column of the separator after the next thing from ``start`` in
+        the absolute line, or before the previous thing if reverse. The
+        whole line is searched without ``start``."""
+        ends, starts, end_x = self.get_boundaries(y, thing)
+        if start is None:
+            start = end_x if reverse else 0
+
+        if reverse:
+            index = bisect.bisect_right(starts, start - 2)
+            return starts[index - 1] if index else None
+
+        index = bisect.bisect_right(ends, start)
+        if index < len(ends) and ends[index] <= end_x:
+            return ends[index]
+        return None
 
-            if string_match and pattern_match:
-                return column
+    def move_to_line(self, line_num: int) -> None:
+        """Move the virtual cursor to the absolute line, scrolling as
+        little as possible."""
+        if line_num < self.base:
+            self.scroll_up(self.base - line_num)
+        elif line_num >= self.base + self.lines:
+            self.scroll_down(line_num - self.base - self.lines + 1)
 
-            if not pattern_match:
-                string_match = True
+        self.virtual_cursor.y = line_num - self.base
 
-        return None
+    def next_thing(self, thing: str) -> None:
+        if not self.in_history:
+            self.base = len(self.history.top)
+        y = self.absolute_y(self.virtual_cursor.y)
+        last_y = len(self.history.top) + self.get_last_blank_line() - 1
 
-    def next_thing(self, thing: str, first: bool = True) -> None:
-        start = self.virtual_cursor.x if first else 0
-        x = self.find(self.virtual_cursor.y, get_regexp(thing), start)
+        x = self.find(y, thing, self.virtual_cursor.x)
+        while x is None and y < last_y:
+            y += 1
+            x = self.find(y, thing)
 
+        self.move_to_line(y)
         self.move_beginning_of_line()
-
-        if x is None and self.at_bottom():
-            self.move_end_of_line()
-            return
-
         if x is None:
-            self.next_line()
-            self.next_thing(thing, False)
+            self.move_end_of_line()
         else:
             self.next_character(x)
 
-    def previous_thing(self, thing: str, first: bool = True) -> None:
-        start = (
-            self.virtual_cursor.x if first else self.get_end_x(self.virtual_cursor.y)
-        )
-        x = self.find(self.virtual_cursor.y, get_regexp(thing), start, True)
+    def previous_thing(self, thing: str) -> None:
+        if not self.in_history:
+            self.base = len(self.history.top)
+        y = self.absolute_y(self.virtual_cursor.y)
 
-        if x is None and self.at_top():
-            self.move_beginning_of_line()
-            return
+        x = self.find(y, thing, self.virtual_cursor.x, True)
+        while x is None and y > 0:
+            y -= 1
+            x = self.find(y, thing, reverse=True)
 
-        if x is None:
-            self.previous_line()
-            self.move_end_of_line()
-            self.previous_thing(thing, False)
-        else:
-            self.move_beginning_of_line()
+        self.move_to_line(y)
+        self.move_beginning_of_line()
+        if x is not None:
             self.next_character(x + 1)
 
     def move_beginning_of_line(self) -> None:
@@ -383,106 +1146,111 @@ class TerminalScreen(HistoryScreen):
         self.virtual_cursor.x = self.get_end_x(self.virtual_cursor.y)
         self.max_virtual_cursor_x = self.virtual_cursor.x
 
-    def update_line(self, y1: int, y2: int) -> None:
-        if y1 == y2:
-            self.dirty.add(y1)
-        else:
-            start = min(y1, y2)
-            end = max(y1, y2)
-            self.dirty.update(range(start, end + 1))
-
     def toggle_mark(self) -> None:
         cursor = self.virtual_cursor
-        if self.marker:
-            old_marker_y = self.marker[1] - self.base
-            if old_marker_y < 0:
-                old_marker_y = 0
-            elif old_marker_y >= self.lines:
-                old_marker_y = self.lines - 1
-        else:
-            old_marker_y = cursor.y
 
         if self.marker == (cursor.x, self.absolute_y(cursor.y)) or self.fake_marker:
             self.marker = ()
         else:
             self.marker = (cursor.x, self.absolute_y(cursor.y))
 
-        self.update_line(cursor.y, old_marker_y)
+    def resolve_selection(self) -> None:
+        """Settle the selection before a frame is drawn."""
+        cursor = self.virtual_cursor
+
+        # The highlight of a copied thing is dropped once the cursor moves
+        if self.fake_marker and (
+            cursor.x != self.old_cursor.x or cursor.y != self.old_cursor.y
+        ):
+            self.marker = ()
+            self.fake_marker = False
+
+        if self.marker and self.mouse:
+            cursor.y = self.absolute_virtual_cursor_y - self.base
 
-    def get_selection(self, y: int) -> range:
+    def selection_spans(self) -> dict[int, range]:
+        """Selected columns of the visible lines, keyed by absolute line."""
         if self.marker == ():
-            return range(0)
+            return {}
 
         cursor = self.virtual_cursor
+        if self.fake_marker and not self.mouse:
+            cursor = self.old_marker_cursor
 
-        if self.fake_marker:
-            if cursor.x != self.old_cursor.x or cursor.y != self.old_cursor.y:
-                self.toggle_mark()
-                self.fake_marker = False
-                return range(0)
-            elif not self.mouse:
-                cursor = self.old_marker_cursor
+        key = (self.marker, self.base, cursor.x, cursor.y)
+        if key == self.selection_key and not self.dirty:
+            return self.selection
 
         marker_x, marker_y = self.marker[0], self.marker[1] - self.base
-        end_x = self.get_end_x(y)
-
         if marker_y < 0:
             marker_x = 0
         elif marker_y >= self.lines:
             marker_x = self.get_end_x(self.lines - 1)
 
-        if self.mouse:
-            cursor.y = self.absolute_virtual_cursor_y - self.base
+        (start_y, start_x), (end_y, end_x) = sorted(
+            [(cursor.y, cursor.x), (marker_y, marker_x)]
+        )
 
-        if cursor.y < y < marker_y or cursor.y > y > marker_y:
-            return range(0, end_x)
-        elif cursor.y == y == marker_y:
-            return range(min(cursor.x, marker_x), max(cursor.x, marker_x))
-        elif y == cursor.y:
-            if marker_y < cursor.y:
-                return range(0, cursor.x)
-            else:
-                return range(cursor.x, end_x)
-        elif y == marker_y:
-            if marker_y < cursor.y:
-                return range(marker_x, end_x)
-            else:
-                return range(0, marker_x)
+        spans = {}
+        for y in range(max(start_y, 0), min(end_y, self.lines - 1) + 1):
+            span = range(
+                start_x if y == start_y else 0,
+                end_x if y == end_y else self.get_end_x(y),
+            )
+            if span:
+                spans[y + self.base] = span
 
-        return range(0)
+        self.selection_key = key
+        self.selection = spans
+        return spans
 
-    def _copy(self, start: int, end: int) -> None:
-        text = ""
+    def get_selection_range(self) -> tuple[tuple[int, int], tuple[int, int]]:
+        cursor = self.virtual_cursor
+        (start_y, start_x), (end_y, end_x) = sorted(
+            [(self.absolute_y(cursor.y), cursor.x), (self.marker[1], self.marker[0])]
+        )
+        return (start_x, start_y), (end_x, end_y)
+
+    def get_history_range(self) -> tuple[tuple[int, int], tuple[int, int]]:
+        end_y = len(self.history.top) + self.get_last_blank_line() - 1
+        return (0, 0), (self.columns, end_y)
+
+    def get_lines(self, start: tuple[int, int], end: tuple[int, int]) -> list:
+        """Lines from ``start`` to ``end`` in absolute positions as
+        ``(line, start_x, end_x)``, the lines on the screen are copied so
+        they can be read while the screen changes."""
+        if start[1] < 0:
+            start = (0, 0)
+
+        top = self.history.top
+        top_length = len(top)
+        lines = list(islice(top, start[1], min(end[1] + 1, top_length)))
+        lines.extend(
+            copy.copy(self.buffer[y - top_length])
+            for y in range(max(start[1], top_length), end[1] + 1)
+        )
 
-        for y in range(start[1], end[1] + 1):
-            start_x = start[0] if y == start[1] else 0
-            end_x = end[0] if y == end[1] else self.columns
-            line = self.get_line_display(
-                y, in_buffer=self.is_buffer, start=start_x, end=end_x, absolute=True
+        return [
+            (
+                line,
+                start[0] if y == start[1] else 0,
+                end[0] if y == end[1] else self.columns,
             )
-            line_strip = line.rstrip()
-            text += line if line == line_strip else line_strip + "\n"
+            for y, line in enumerate(lines, start[1])
+        ]
 
-        message_to_emacs("Copy text")
-        set_clipboard_text(text)
+    def _copy(self, start: tuple[int, int], end: tuple[int, int]) -> None:
+        text = "".join(text_line(*line) for line in self.get_lines(start, end))
+
+        self.on_message("Copy text")
+        self.on_clipboard(text)
 
     def _copy_selection(self) -> None:
         if self.marker == ():
-            message_to_emacs("Nothing selected")
+            self.on_message("Nothing selected")
             return
 
-        cursor = self.virtual_cursor
-        cursor_y = self.absolute_y(cursor.y)
-        (marker_x, marker_y) = self.marker
-
-        if (cursor_y == marker_y and marker_x < cursor.x) or (marker_y < cursor_y):
-            start = (marker_x, marker_y)
-            end = (cursor.x, cursor_y)
-        elif (cursor_y == marker_y and cursor.x < marker_x) or (cursor_y < marker_y):
-            start = (cursor.x, cursor_y)
-            end = (marker_x, marker_y)
-
-        self._copy(start, end)
+        self._copy(*self.get_selection_range())
         self.toggle_mark()
         self.toggle_mark()
 
@@ -493,7 +1261,7 @@ class TerminalScreen(HistoryScreen):
                 if self.in_history:
                     self.cursor_move_mode = False
                     self.virtual_cursor.hidden = True
-                    eval_in_emacs("eaf--toggle-cursor-move-mode", ["'nil"])
+                    self.notify_cursor_move_mode(False)
                 else:
                     self.toggle_cursor_move_mode(False)
 
@@ -517,7 +1285,7 @@ class TerminalScreen(HistoryScreen):
         current_match = bool(regexp.match(line[cursor.x].data))
 
         if after_match and current_match:
-            message_to_emacs("Nothing selected")
+            self.on_message("Nothing selected")
             return
 
         if not after_match:
@@ -551,7 +1319,6 @@ class TerminalScreen(HistoryScreen):
         elif y < 0:
             x, y = 0, 0
 
-        self.update_line(y, self.virtual_cursor.y)
         self.virtual_cursor.x, self.virtual_cursor.y = x, y
         self.max_virtual_cursor_x = x
         self.adjust_x(y)
@@ -565,35 +1332,16 @@ class TerminalScreen(HistoryScreen):
 
         self.marker = (x, y + self.base)
 
-    def _auto_scroll_up(self) -> None:
-        while not self.auto_scroll_lock:
-            self.scroll_up(1)
-            self.absolute_virtual_cursor_y -= 1
-
-            # Need to recalibrate the x of the virtual cursor to avoid
-            # the virtual cursor being displayed at the empty end of a line
-            self.adjust_x(self.virtual_cursor.y)
-
-            time.sleep(0.05)
+    def auto_scroll(self, line_num: int) -> None:
+        """Scroll while selecting with the mouse, up if ``line_num`` is
+        negative."""
+        old_base = self.base
+        if line_num < 0:
+            self.scroll_up(-line_num)
+        else:
+            self.scroll_down(line_num)
+        self.absolute_virtual_cursor_y += self.base - old_base
 
-    def _auto_scroll_down(self) -> None:
-        while not self.auto_scroll_lock:
-            self.scroll_down(1)
-            self.absolute_virtual_cursor_y += 1
-            self.adjust_x(self.virtual_cursor.y)
-            time.sleep(0.05)
-
-    def auto_scroll_up(self) -> None:
-        self.auto_scroll_lock = False
-        self.current_thread = threading.Thread(target=self._auto_scroll_up)
-        self.current_thread.start()
-
-    def auto_scroll_down(self) -> None:
-        self.auto_scroll_lock = False
-        self.current_thread = threading.Thread(target=self._auto_scroll_down)
-        self.current_thread.start()
-
-    def disable_auto_scroll(self) -> None:
-        self.auto_scroll_lock = True
-        self.current_thread.join()
-        self.current_thread = None
+        # Need to recalibrate the x of the virtual cursor to avoid
+        # the virtual cursor being displayed at the empty end of a line
+        self.adjust_x(self.virtual_cursor.y)
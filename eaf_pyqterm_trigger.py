@@ -0,0 +1,101 @@
+# Copyright (C) 2023 by Mumulhl <mumulhl@duck.com>
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+"""Triggers on the output of a terminal.
+
+Every pattern is indexed by the first characters of a literal that all
+its matches contain. A line is cut into grams once, and only the patterns
+whose gram is in the line are searched, so the cost of a line doesn't
+grow with the number of triggers. Patterns without such a literal are
+always searched.
+"""
+
+import re
+
+try:
+    from re import _parser as sre_parse
+except ImportError:
+    import sre_parse
+
+# Minimum interval between two notifications of the same trigger
+TRIGGER_INTERVAL = 1
+# Length of the grams of literals
+GRAM_LENGTH = 3
+
+
+def required_literal(pattern: str) -> str:
+    """The longest literal every match of ``pattern`` contains, only the
+    top level of the pattern is looked at."""
+    parsed = sre_parse.parse(pattern)
+    if parsed.state.flags & re.IGNORECASE:
+        return ""
+
+    literal = ""
+    run = []
+    for op, value in list(parsed) + [(None, None)]:
+        if op is sre_parse.LITERAL:
+            run.append(chr(value))
+            continue
+
+        if len(run) > len(literal):
+            literal = "".join(run)
+        run = []
+
+    return literal
+
+
+class Triggers:
+    def __init__(self, triggers: list[tuple[str, str]]):
+        """``triggers`` are ``(name, pattern)`` pairs of Python regexps,
+        invalid patterns are skipped and their names kept in ``errors``."""
+        self.names: list[str] = []
+        self.errors: list[str] = []
+        self.patterns: list[re.Pattern] = []
+
+        # Indexes of patterns by the gram of their literal, and by the
+        # lengths of grams
+        self.grams: dict[str, list[int]] = {}
+        self.gram_lengths: set[int] = set()
+        self.always: list[int] = []
+
+        for name, pattern in triggers:
+            try:
+                regexp = re.compile(pattern)
+                literal = required_literal(pattern)
+            except re.error:
+                self.errors.append(name)
+                continue
+
+            index = len(self.patterns)
+            if literal:
+                gram = literal[:GRAM_LENGTH]
+                self.grams.setdefault(gram, []).append(index)
+                self.gram_lengths.add(len(gram))
+            else:
+                self.always.append(index)
+
+            self.names.append(name)
+            self.patterns.append(regexp)
+
+        self.last_times: dict[str, float] = {}
+
+    def match(self, text: str) -> str | None:
+        """Name of the first trigger matching ``text``."""
+        candidates = set(self.always)
+        for length in self.gram_lengths:
+            grams = {text[i : i + length] for i in range(len(text) - length + 1)}
+            for gram in grams & self.grams.keys():
+                candidates.update(self.grams[gram])
+
+        for index in sorted(candidates):
+            if self.patterns[index].search(text):
+                return self.names[index]
+        return None
+
+    def ready(self, name: str, now: float) -> bool:
+        """Whether ``name`` can notify now."""
+        if now - self.last_times.get(name, 0) < TRIGGER_INTERVAL:
+            return False
+
+        self.last_times[name] = now
+        return True
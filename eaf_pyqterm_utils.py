@@ -18,10 +18,17 @@ def generate_random_key(count: int, letters: str) -> list[str]:
 
 
 import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable
 
 LINK_PATTERN = re.compile(r"(https?://(?:[\w-]+\.)+[\w-]+(?:/[\w/?%&=-]*)?)")
 WORD_PATTERN = re.compile(r"[\s,\._()=*\"'\[\]/-]")
 SYMBOL_PATTERN = re.compile(r"\s")
+# Runs of the characters between separators
+WORD_RUN_PATTERN = re.compile(r"[^\s,\._()=*\"'\[\]/-]+")
+SYMBOL_RUN_PATTERN = re.compile(r"\S+")
 
 
 def match_link(text: str) -> (dict[int, str], int):
@@ -39,8 +46,91 @@ def match_link(text: str) -> (dict[int, str], int):
     return links, count
 
 
+def get_wide_mask(line) -> int:
+    """Bitmap of the wide characters of a line, bit x is set if the
+    character at x is wide, i.e. the cell after it is a stub."""
+    mask = 0
+    for x, char in line.items():
+        if char.data == "" and x > 0:
+            mask |= 1 << (x - 1)
+    return mask
+
+
+def is_wide(line, x: int) -> bool:
+    return x >= 0 and bool(line.wide >> x & 1)
+
+
+def get_link(line, x: int) -> str | None:
+    """URL of the OSC 8 link at x."""
+    link = line.links and line.links.get(x)
+    return link.url if link else None
+
+
 def get_regexp(thing: str):
     if thing == "word":
         return WORD_PATTERN
     elif thing == "symbol":
         return SYMBOL_PATTERN
+
+
+def get_run_regexp(thing: str):
+    if thing == "word":
+        return WORD_RUN_PATTERN
+    elif thing == "symbol":
+        return SYMBOL_RUN_PATTERN
+
+
+class Notifier:
+    """Coalesce notifications to Emacs.
+
+    Only the latest notification of a key is sent, at most once per
+    ``interval`` seconds, and only if it differs from the last one sent.
+    Notifications are posted by the reading thread and flushed by the GUI
+    thread."""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.last_flush = 0
+        self.pending: dict[str, tuple[Callable, tuple]] = {}
+        self.sent: dict[str, tuple] = {}
+        self.lock = threading.Lock()
+
+    def post(self, key: str, func: Callable, *args) -> None:
+        with self.lock:
+            self.pending[key] = (func, args)
+
+    def flush(self) -> None:
+        now = time.time()
+        with self.lock:
+            if not self.pending or now - self.last_flush < self.interval:
+                return
+
+            self.last_flush = now
+            pending, self.pending = self.pending, {}
+
+        for key, (func, args) in pending.items():
+            if self.sent.get(key) != args:
+                self.sent[key] = args
+                func(*args)
+
+
+class LoadedLines:
+    """The lazy history lines which are decoded.
+
+    The lines are decoded on use and counted at their encoded size, so
+    past ``size`` lines the least recently loaded one is unloaded, and
+    reading the whole history doesn't grow its memory for good."""
+
+    def __init__(self, size: int):
+        self.size = size
+        # Lines by id, which stays unique as long as the line is here
+        self.lines: OrderedDict[int, object] = OrderedDict()
+        self.lock = threading.Lock()
+
+    def add(self, line) -> None:
+        with self.lock:
+            self.lines[id(line)] = line
+            if len(self.lines) <= self.size:
+                return
+            _, oldest = self.lines.popitem(last=False)
+        oldest.unload()
@@ -0,0 +1,102 @@
+import errno
+import os
+import sys
+import threading
+import time
+
+from eaf_pyqterm_backend import Backend, Pty
+
+OUTPUT_SIZE = 100000
+
+
+def test_read_output_of_exited_child():
+    # The child exits right after writing, its output is read with the
+    # error of the closed pty
+    argv = [sys.executable, "-c", f"print('x' * {OUTPUT_SIZE}, end='')"]
+    pty = Pty(80, 24, argv, os.getcwd())
+
+    output = bytearray()
+    try:
+        while True:
+            output += pty.read()
+    except OSError:
+        pass
+    finally:
+        pty.close()
+
+    assert output == b"x" * OUTPUT_SIZE
+
+
+def test_write_without_reading(tmp_path):
+    # The reading thread may be busy feeding the screen, input still goes
+    # out right away
+    path = tmp_path / "input"
+    script = f"open({str(path)!r}, 'w').write(input())"
+    pty = Pty(80, 24, [sys.executable, "-c", script], os.getcwd())
+    try:
+        pty.write(b"keys\r")
+        deadline = time.monotonic() + 5
+        while not (path.exists() and path.read_text()):
+            assert time.monotonic() < deadline
+            time.sleep(0.01)
+    finally:
+        pty.close()
+
+    assert path.read_text() == "keys"
+    assert not pty.write_queue
+
+
+def test_export_reports_errors():
+    backend = Backend(80, 24, ["/bin/sh", "-c", "sleep 5"], os.getcwd())
+    backend.close_buffer = lambda: None
+    messages = []
+    closed = []
+    reported = threading.Event()
+
+    def on_message(text):
+        messages.append(text)
+        reported.set()
+
+    backend.set_callbacks(message=on_message)
+
+    def write(chunk):
+        raise OSError(errno.ENOSPC, "No space left on device")
+
+    try:
+        backend.feed(b"some output\r\n")
+        backend.export(
+            (0, 0),
+            (80, 0),
+            write,
+            "text",
+            {},
+            lambda line_num: messages.append("exported"),
+            lambda: closed.append(True),
+        )
+        assert reported.wait(5)
+    finally:
+        backend.close()
+
+    assert messages == ["Export failed: [Errno 28] No space left on device"]
+    assert closed == [True]
+
+
+def test_host_fallback(tmp_path, monkeypatch):
+    # Another user could put a socket in a directory which isn't private
+    monkeypatch.setenv("XDG_RUNTIME_DIR", str(tmp_path))
+    (tmp_path / f"eaf-pyqterminal-{os.getuid()}").mkdir(mode=0o755)
+
+    backend = Backend(80, 24, ["/bin/sh", "-c", "sleep 5"], os.getcwd(), use_host=True)
+    backend.close_buffer = lambda: None
+    messages = []
+    backend.set_callbacks(message=messages.append)
+    backend.notifier.interval = 0
+    try:
+        backend.notifier.flush()
+        assert isinstance(backend.pty, Pty)
+        assert not backend.is_hosted()
+    finally:
+        backend.close()
+
+    assert len(messages) == 1
+    assert messages[0].startswith("Can't use the host")
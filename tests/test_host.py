@@ -0,0 +1,86 @@
+from pyte import modes as mo
+
+from eaf_pyqterm_host import ScreenState
+
+
+def screen_lines(screen):
+    return [screen.get_line_display(y, in_buffer=True) for y in range(screen.lines)]
+
+
+def history_lines(screen):
+    return [
+        "".join(line[x].data for x in range(screen.columns))
+        for line in screen.history.top
+    ]
+
+
+def assert_same_screen(screen, other):
+    assert screen_lines(screen) == screen_lines(other)
+    assert (screen.cursor.x, screen.cursor.y) == (other.cursor.x, other.cursor.y)
+    assert screen.cursor.attrs == other.cursor.attrs
+    assert screen.cursor.hidden == other.cursor.hidden
+    assert screen.margins == other.margins
+    assert screen.mode == other.mode
+    for y in range(screen.lines):
+        line, other_line = screen.buffer[y], other.buffer[y]
+        assert [line[x] for x in range(screen.columns)] == [
+            other_line[x] for x in range(screen.columns)
+        ]
+
+
+def reattach(state, columns=20, lines=5):
+    client = ScreenState(columns, lines)
+    # The snapshot is a single chunk, like the OUTPUT message
+    client.feed(state.snapshot())
+    return client
+
+
+def test_snapshot_rebuilds_screen_and_history():
+    state = ScreenState(20, 5)
+    for n in range(12):
+        state.feed(f"line \x1b[1;31m{n}\x1b[0m\r\n".encode())
+    state.feed(b"\x1b[44mwrapped line longer than the screen")
+    state.feed(b"\x1b[4h\x1b[?2004h\x1b[?25l\x1b[2;4r\x1b[3;5H\x1b[7m")
+
+    client = reattach(state)
+
+    assert_same_screen(state.screen, client.screen)
+    assert history_lines(client.screen) == history_lines(state.screen)
+    assert mo.IRM in client.screen.mode
+    assert not client.in_buffer_screen
+
+
+def test_snapshot_rebuilds_buffer_screen():
+    state = ScreenState(20, 5)
+    state.feed(b"shell prompt\r\n")
+    state.feed(b"\x1b[?1049h\x1b[2J\x1b[H\x1b[?1")
+    # The output is cut in the middle of sequences
+    state.feed(b"h editor\x1b[")
+    state.feed(b"3;2H")
+
+    client = reattach(state)
+
+    assert client.in_buffer_screen
+    assert_same_screen(state.screen, client.screen)
+    assert_same_screen(state.buffer_screen, client.buffer_screen)
+
+
+def test_snapshot_keeps_pending_wrap():
+    state = ScreenState(20, 5)
+    state.feed(b"x" * 20)
+
+    client = reattach(state)
+    state.feed(b"y")
+    client.feed(b"y")
+
+    assert_same_screen(state.screen, client.screen)
+
+
+def test_switch_cut_between_chunks():
+    state = ScreenState(20, 5)
+    state.feed(b"main\x1b[?10")
+    state.feed(b"49hbuffer")
+
+    assert state.in_buffer_screen
+    assert screen_lines(state.screen)[0].rstrip() == "main"
+    assert screen_lines(state.buffer_screen)[0].rstrip() == "buffer"
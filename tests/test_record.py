@@ -0,0 +1,20 @@
+from eaf_pyqterm_record import Recorder, read_records, replay
+
+
+def test_read_records(tmp_path):
+    path = str(tmp_path / "output.rec")
+    recorder = Recorder(path)
+    chunks = [b"x" * size for size in (0, 1, 70000, 5)]
+    for chunk in chunks:
+        recorder.write(chunk)
+    recorder.close()
+
+    records = list(read_records(path))
+    assert [data for _, data in records] == chunks
+    assert [timestamp for timestamp, _ in records] == sorted(
+        timestamp for timestamp, _ in records
+    )
+
+    written = []
+    assert replay(path, written.append, realtime=False)[0] == sum(map(len, chunks))
+    assert written == chunks
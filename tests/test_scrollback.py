@@ -0,0 +1,47 @@
+from eaf_pyqterm_scrollback import CompressedLine
+from eaf_pyqterm_session import LOADED_LINES, Session
+from eaf_pyqterm_term import TerminalScreen, TerminalStream
+
+
+def line_text(line, columns):
+    return "".join(line[x].data for x in range(columns)).rstrip()
+
+
+def test_reading_compressed_lines_keeps_them_compressed():
+    screen = TerminalScreen(False, 40, 10, 5000)
+    stream = TerminalStream(screen)
+    for n in range(3000):
+        stream.feed(f"line {n} \x1b[31mred\x1b[0m\r\n".encode())
+
+    assert screen.compress_history(1 << 30) > 0
+    history_bytes = screen.history_bytes
+    lines = [line for line in screen.history.top if type(line) is CompressedLine]
+    assert len(lines) > LOADED_LINES
+
+    # Like an export of the whole history
+    texts = [line_text(line, screen.columns) for line in lines]
+
+    assert texts[0] == "line 0 red"
+    assert sum(line.loaded for line in lines) <= LOADED_LINES
+    assert screen.history_bytes == history_bytes
+    # Unloaded lines are decoded again
+    assert line_text(lines[0], screen.columns) == "line 0 red"
+
+
+def test_reading_restored_lines_keeps_them_on_disk(tmp_path):
+    screen = TerminalScreen(False, 40, 10, 5000)
+    stream = TerminalStream(screen)
+    session = Session(str(tmp_path / "session"), 5000)
+    screen.session = session
+    for n in range(2000):
+        stream.feed(f"line {n}\r\n".encode())
+    session.close()
+
+    session = Session(str(tmp_path / "session"), 5000)
+    lines = session.restored_lines()
+    texts = [line_text(line, 40) for line in lines]
+    session.close()
+
+    assert texts[:2] == ["line 0", "line 1"]
+    assert sum(line.loaded for line in lines) <= LOADED_LINES
+    assert line_text(lines[0], 40) == "line 0"
@@ -0,0 +1,139 @@
+import copy
+import random
+import time
+
+from eaf_pyqterm_term import TerminalScreen, TerminalStream, collapse_overwrites
+from eaf_pyqterm_trigger import Triggers
+from eaf_pyqterm_utils import Notifier, get_link
+
+
+def make_screen(columns=80, lines=24):
+    screen = TerminalScreen(False, columns, lines, 1000)
+    return screen, TerminalStream(screen)
+
+
+def test_copy_keeps_links():
+    screen, stream = make_screen()
+    stream.feed(b"\x1b]8;;https://example.com\x1b\\link text\x1b]8;;\x1b\\ after")
+
+    line = screen.buffer[0]
+    copied = copy.copy(line)
+
+    assert [get_link(line, x) for x in range(9)] == ["https://example.com"] * 9
+    assert [get_link(copied, x) for x in range(9)] == ["https://example.com"] * 9
+    assert get_link(line, 9) is None
+
+    copied[0] = copied[1]
+    assert get_link(line, 0) == "https://example.com"
+
+
+def test_get_lines_keeps_links():
+    screen, stream = make_screen()
+    stream.feed(b"\x1b]8;;https://example.com\x1b\\link\x1b]8;;\x1b\\")
+
+    screen.get_lines((0, 0), (screen.columns, 0))
+
+    assert get_link(screen.buffer[0], 0) == "https://example.com"
+
+
+def feed_collapsed(stream, data, columns):
+    if stream.can_collapse():
+        data = collapse_overwrites(data, columns)
+    stream.feed(data)
+
+
+def assert_same_lines(screen, other):
+    for y in range(screen.lines):
+        assert [screen.buffer[y][x] for x in range(screen.columns)] == [
+            other.buffer[y][x] for x in range(screen.columns)
+        ]
+    assert (screen.cursor.x, screen.cursor.y) == (other.cursor.x, other.cursor.y)
+
+
+def test_collapse_keeps_insert_mode():
+    for chunks in (
+        [b"abcdef\rX\rYZ\r\n"],
+        [b"\x1b[4habcdef\rX\rYZ\r\n"],
+        [b"\x1b[4h", b"abcdef\rX\rYZ\r\n"],
+        [b"\x1b[", b"4habcdef\rX\rYZ\r\n"],
+        [b"\x1b[20;4h", b"abcdef\rX\rYZ\r\n"],
+    ):
+        screen, stream = make_screen(20, 5)
+        collapsed, collapsed_stream = make_screen(20, 5)
+        for chunk in chunks:
+            stream.feed(chunk)
+            feed_collapsed(collapsed_stream, chunk, 20)
+        assert_same_lines(screen, collapsed)
+
+
+def test_collapse_fuzz():
+    pieces = [
+        b"ab",
+        b"0123456789",
+        b"\xe4\xb8\xad",
+        b"\r",
+        b"\r\n",
+        b"\x1b[1;31m",
+        b"\x1b[0m",
+        b"\x1b[K",
+        b"\x1b[2K",
+        b"\x1b[4h",
+        b"\x1b[4l",
+        b"\x1b[",
+        b"4",
+        b"h",
+        b"\x1b[3D",
+    ]
+    for seed in range(500):
+        rng = random.Random(seed)
+        screen, stream = make_screen(12, 4)
+        collapsed, collapsed_stream = make_screen(12, 4)
+        for _ in range(8):
+            chunk = b"".join(rng.choice(pieces) for _ in range(rng.randint(1, 12)))
+            stream.feed(chunk)
+            feed_collapsed(collapsed_stream, chunk, 12)
+        assert_same_lines(screen, collapsed)
+
+
+def test_repeated_trigger_is_notified(monkeypatch):
+    screen, stream = make_screen()
+    screen.triggers = Triggers([("done", "build done")])
+    screen.notifier = Notifier(0)
+    fired = []
+    screen.on_trigger = lambda *args: fired.append(args)
+
+    now = iter(range(10, 100, 10))
+    monkeypatch.setattr(time, "monotonic", lambda: next(now))
+    for _ in range(2):
+        stream.feed(b"build done\r\n")
+        screen.notifier.flush()
+
+    assert [(name, text) for name, text, _ in fired] == [("done", "build done")] * 2
+
+
+def test_trigger_fires_again_after_clear(monkeypatch):
+    screen, stream = make_screen()
+    screen.triggers = Triggers([("done", "build done")])
+    fired = []
+    screen.on_trigger = lambda *args: fired.append(args)
+
+    now = iter(range(10, 100, 10))
+    monkeypatch.setattr(time, "monotonic", lambda: next(now))
+    for _ in range(2):
+        stream.feed(b"\x1b[2J\x1b[Hbuild done\r\n")
+
+    assert len(fired) == 2
+    assert fired[0][2] == fired[1][2]
+
+
+def test_equal_history_lines_are_shared():
+    screen, stream = make_screen(20, 5)
+    # The same text, drawn in another order and with a link removed
+    stream.feed(b"abc\r\n")
+    stream.feed(b"  c\rab\r\n")
+    stream.feed(b"\x1b]8;;https://example.com\x1b\\a\x1b]8;;\x1b\\\rabc\r\n")
+    stream.feed(b"\r\n" * 5)
+
+    top = list(screen.history.top)
+    assert top[0] is top[1] is top[2]
+    assert screen.history_table.uses(top[0]) == 3